@@ -0,0 +1,93 @@
+# benchmarks/bench_parsing.py
+
+"""Compare the original full-tree html.parser parsing of search and shelf pages with the strained parsing layer
+and the streaming shelf parser.
+
+    python benchmarks/bench_parsing.py [--repeat N]
+"""
+
+import argparse
+import re
+import sys
+import timeit
+from datetime import datetime
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "goldfinch"))
+
+from bs4 import BeautifulSoup
+
+import fixtures
+import parsing
+from downloader import Downloader
+from goodreads import parse_shelf
+
+TITLE = "Synthetic Book"
+
+def legacy_parse_search(content: bytes, title: str, locale: int) -> list:
+    """search_libgen's parsing before the parsing layer, kept for comparison"""
+    soup = BeautifulSoup(content, "html.parser")
+    table = soup.find("table", class_ = "catalog" if locale == Downloader.FICTION else "c")
+    items = table.find_all("tr")[1:]
+    return_links = []
+    for item in items:
+        item_title = item.find_all("td")[2].find("a").text
+        if (item_title not in title and title not in item_title): continue
+        mirrors = item.find_all("ul", class_ = "record_mirrors_compact") if locale == Downloader.FICTION else item.find_all("td")[9:10]
+        links = mirrors[0].find_all("li") if locale == Downloader.FICTION else mirrors
+        return_links.append(links[0].find("a")["href"])
+    return return_links
+
+def legacy_parse_shelf(content: bytes) -> dict:
+    """the shelf parsing from before the parsing layer, kept for comparison"""
+    soup = BeautifulSoup(content, "html.parser")
+    results = soup.find_all("tr", class_ = "bookalike review")
+    books = {}
+    for item in results:
+        title = item.find("td", class_ = "field title").text[5:].strip().replace("\n", "")
+        brackets_pattern = re.compile(r"[\[({].*[\])}]")
+        title = brackets_pattern.sub("", title).strip()
+        author = item.find("td", class_ = "field author").text[6:].strip().replace("\n", "")
+        author = author.replace("*", "")
+        date_added = item.find("td", class_ = "field date_added").text[10:].strip().replace("\n", "")
+        date_added = datetime.strptime(date_added, "%b %d, %Y").strftime("%m-%d-%Y")
+        books[title + author] = {"title": title, "author": author, "date_added": date_added}
+    return books
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    downloader = Downloader(Path("."))
+    fiction = fixtures.libgen_fiction_page(TITLE, rows=25).encode()
+    nonfiction = fixtures.libgen_nonfiction_page(TITLE, rows=100).encode()
+    shelf = fixtures.goodreads_shelf_page([fixtures.book(i) for i in range(100)], 1, 100).encode()
+
+    for page, locale in ((fiction, Downloader.FICTION), (nonfiction, Downloader.NONFICTION)):
+        results = downloader.parse_search(page, locale).results
+        assert legacy_parse_search(page, TITLE, locale) == [result["mirrors"][0] for result in results if TITLE in result["title"]]
+    #The parsing layer also keys books by id and keeps their Goodreads id and ISBN, compare what both extract
+    fields = ("title", "author", "date_added")
+    assert [tuple(book[field] for field in fields) for book in legacy_parse_shelf(shelf).values()] == \
+        [tuple(book[field] for field in fields) for book in parse_shelf(shelf.decode()).values()]
+
+    cases = [
+        ("fiction search, 25 rows",
+         lambda: legacy_parse_search(fiction, TITLE, Downloader.FICTION),
+         lambda: downloader.parse_search(fiction, Downloader.FICTION)),
+        ("nonfiction search, 100 rows",
+         lambda: legacy_parse_search(nonfiction, TITLE, Downloader.NONFICTION),
+         lambda: downloader.parse_search(nonfiction, Downloader.NONFICTION)),
+        ("goodreads shelf, 100 rows",
+         lambda: legacy_parse_shelf(shelf),
+         lambda: parse_shelf(shelf.decode())),
+    ]
+    print(f"parser: {parsing.PARSER}")
+    for name, legacy, current in cases:
+        legacy_time = min(timeit.repeat(legacy, number=1, repeat=args.repeat))
+        current_time = min(timeit.repeat(current, number=1, repeat=args.repeat))
+        print(f"{name:30} legacy {legacy_time * 1000:8.2f} ms   current {current_time * 1000:8.2f} ms   {legacy_time / current_time:5.1f}x")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+# benchmarks/bench_startup.py
+
+"""Measure how long the CLI takes to import, and check lightweight commands stay clear of the network stack.
+
+    python benchmarks/bench_startup.py [--repeat N] [--budget-ms MS]
+
+Each measurement runs `python -X importtime` in a fresh interpreter. Exits with 1 if importing
+the CLI pulls in a network or parsing dependency, or if its median import time is over --budget-ms.
+"""
+
+import argparse
+import statistics
+import subprocess
+import sys
+from pathlib import Path
+
+GOLDFINCH_DIR = Path(__file__).resolve().parent.parent / "goldfinch"
+#Only the commands that go online should pay for these
+HEAVY_MODULES = ("requests", "urllib3", "bs4", "lxml", "goodreads", "downloader", "parsing")
+TARGETS = {
+    "cli": "import cli",
+    "goldfinch": "import goldfinch",
+    "downloader": "import downloader",
+    "goodreads": "import goodreads",
+}
+
+def import_times(statement: str) -> dict:
+    """import in a fresh interpreter, returning the cumulative microseconds of every module it loaded"""
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", statement],
+        cwd=GOLDFINCH_DIR, capture_output=True, text=True, check=True,
+    )
+    times = {}
+    for line in process.stderr.splitlines():
+        if (not line.startswith("import time:") or "cumulative" in line): continue
+        _, cumulative, module = line[len("import time:"):].split("|")
+        times[module.strip()] = int(cumulative)
+    return times
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--budget-ms", type=float, help="fail if importing the cli takes longer than this")
+    args = parser.parse_args()
+
+    failed = False
+    for target, statement in TARGETS.items():
+        runs = [import_times(statement) for _ in range(args.repeat)]
+        median_ms = statistics.median(run[target] for run in runs) / 1000
+        heavy = [module for module in HEAVY_MODULES if module in runs[0]]
+        print(f"{target:12} {median_ms:10.1f} ms  heavy imports: {', '.join(heavy) or 'none'}")
+        if (target == "cli"):
+            if (heavy):
+                print(f"cli imports {', '.join(heavy)}, lightweight commands will pay for them")
+                failed = True
+            if (args.budget_ms is not None and median_ms > args.budget_ms):
+                print(f"cli import took {median_ms:.1f} ms, over the {args.budget_ms:g} ms budget")
+                failed = True
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,193 @@
+# benchmarks/bench_suite.py
+
+"""Benchmark update, download, search parsing and the database against the local fake server.
+
+    python benchmarks/bench_suite.py --sizes 100,1000,10000 --output results.json
+
+Results are printed as a table and, with --output, written as JSON for regression tracking.
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import platform
+import sys
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "goldfinch"))
+
+import fixtures
+from fake_server import FakeServer
+from __init__ import __version__, SUCCESS
+import database
+import goldfinch
+import identity
+import parsing
+from downloader import Downloader
+from http_client import HTTPClient, RateLimiter
+
+def timed(function) -> tuple:
+    """run function with its console output hidden, returning its result and the seconds it took"""
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        result = function()
+        return result, time.perf_counter() - start
+
+def make_goldfinch(workdir: Path, server: FakeServer, args: argparse.Namespace) -> goldfinch.Goldfinch:
+    db_path = workdir / "database.json"
+    downloads_path = workdir / "downloads"
+    downloads_path.mkdir(exist_ok=True)
+    database.init_database(db_path, "01-01-2000")
+    return goldfinch.Goldfinch(
+        db_path, server.shelf_url, downloads_path,
+        workers=args.workers,
+        http_client=make_http_client(args),
+        libgen_url=server.base_url,
+    )
+
+def make_http_client(args: argparse.Namespace) -> HTTPClient:
+    return HTTPClient(timeout=10, backoff_factor=0, rate_limiter=RateLimiter(args.client_rate, args.client_burst))
+
+def bench_update(size: int, args: argparse.Namespace) -> list:
+    results = []
+    with FakeServer(size, args.latency, args.failure_rate) as server, tempfile.TemporaryDirectory() as workdir:
+        gf = make_goldfinch(Path(workdir), server, args)
+        for name, full in (("update_db.full", True), ("update_db.incremental", False)):
+            requests_before = server.requests
+            error, seconds = timed(lambda: gf.update_db(full))
+            results.append({"benchmark": name, "books": size, "seconds": seconds,
+                            "requests": server.requests - requests_before, "error": error})
+    return results
+
+def bench_download(size: int, args: argparse.Namespace) -> list:
+    with FakeServer(size, args.latency, args.failure_rate, args.file_size, rate_limit=args.server_rate) as server, \
+            tempfile.TemporaryDirectory() as workdir:
+        gf = make_goldfinch(Path(workdir), server, args)
+        timed(lambda: gf.update_db(True))
+        requests_before, throttled_before = server.requests, server.throttled
+        error, seconds = timed(lambda: gf.download_all(False))
+        db = gf.db_handler.read_db().db
+        return [{"benchmark": "download_all", "books": size, "seconds": seconds, "workers": args.workers,
+                 "requests": server.requests - requests_before, "throttled": server.throttled - throttled_before,
+                 "downloaded": len(db["downloaded_books"]), "failed": len(db["failed_books"]),
+                 "books_per_second": size / seconds, "error": error}]
+
+def bench_search(args: argparse.Namespace) -> list:
+    results = []
+    downloader = Downloader(Path("."))
+    title = fixtures.book(0)["title"]
+    for locale, name, page in (
+        (Downloader.FICTION, "parse_search.fiction", fixtures.libgen_fiction_page(title, 25)),
+        (Downloader.NONFICTION, "parse_search.nonfiction", fixtures.libgen_nonfiction_page(title, 100)),
+    ):
+        content = page.encode()
+        _, seconds = timed(lambda: [downloader.parse_search(content, locale) for _ in range(args.repeat)])
+        results.append({"benchmark": name, "rows": 25 if locale == Downloader.FICTION else 100,
+                        "seconds": seconds / args.repeat})
+    with FakeServer(100, args.latency, args.failure_rate) as server:
+        downloader = Downloader(Path("."), http_client=make_http_client(args), libgen_url=server.base_url)
+        books = [fixtures.book(index) for index in range(args.repeat)]
+        _, seconds = timed(lambda: [
+            downloader.search_libgen(book["title"], book["author"], Downloader.TITLE, Downloader.FICTION) for book in books
+        ])
+        results.append({"benchmark": "search_libgen", "seconds": seconds / len(books)})
+    return results
+
+def bench_database(size: int, args: argparse.Namespace) -> list:
+    results = []
+    db = {
+        "undownloaded_books": {},
+        "downloaded_books": {},
+        "failed_books": {},
+        "date_since_download": "01-01-2000",
+        "sync_watermarks": {},
+        "key_version": identity.KEY_VERSION,
+    }
+    for index in range(size):
+        book = fixtures.book(index)
+        record = {
+            "title": book["title"],
+            "author": book["author"],
+            "date_added": book["date_added"].strftime("%m-%d-%Y"),
+            "owners": ["default"],
+        }
+        #Most of a grown library is downloaded, and those records carry the file's details
+        if (index % 4):
+            record.update({
+                "date_downloaded": "01-01-2024",
+                "link": f"http://library.lol/main/{book['md5']}",
+                "path": f"/books/{book['title'].replace(' ', '_')}.epub",
+                "md5": book["md5"].lower(),
+                "size": 250000 + index,
+                "format": "epub",
+            })
+        db["downloaded_books" if index % 4 else "undownloaded_books"][identity.book_id(book["title"], book["author"])] = record
+    with tempfile.TemporaryDirectory() as workdir:
+        for backend, filename, db_format in (("json pretty", "pretty.json", "pretty"), ("json compact", "compact.json", "compact"),
+                                             ("sqlite", "database.db", None)):
+            db_handler = database.get_db_handler(Path(workdir) / filename, db_format)
+            write, write_seconds = timed(lambda: db_handler.write_db(db))
+            read, read_seconds = timed(lambda: db_handler.read_db())
+            assert write.error == SUCCESS and read.error == SUCCESS and read.db["downloaded_books"] == db["downloaded_books"]
+            size_mb = (Path(workdir) / filename).stat().st_size / 1e6
+            results.append({"benchmark": "write_db", "backend": backend, "books": size, "file_mb": round(size_mb, 1), "seconds": write_seconds})
+            results.append({"benchmark": "read_db", "backend": backend, "books": size, "seconds": read_seconds})
+            #What add, priority and each merge do: write back a read db with one book changed
+            key = next(iter(read.db["undownloaded_books"]))
+            read.db["undownloaded_books"][key] = dict(read.db["undownloaded_books"][key], priority=1)
+            write, write_seconds = timed(lambda: db_handler.write_db(read.db))
+            assert write.error == SUCCESS and db_handler.read_db().db["undownloaded_books"][key]["priority"] == 1
+            results.append({"benchmark": "write_db.one_change", "backend": backend, "books": size, "seconds": write_seconds})
+    return results
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="100,1000,10000", help="comma separated library sizes")
+    parser.add_argument("--max-download", type=int, default=1000, help="largest size download_all is run at")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds the fake server adds to every response")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="fraction of requests the fake server fails")
+    parser.add_argument("--file-size", type=int, default=256 * 1024)
+    parser.add_argument("--server-rate", type=float, default=0.0, help="requests per second the fake server answers before sending 429s")
+    parser.add_argument("--client-rate", type=float, default=0.0, help="goldfinch's per-host requests per second, 0 for no limit")
+    parser.add_argument("--client-burst", type=int, default=8)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--only", choices=["update", "download", "search", "database"], action="append")
+    parser.add_argument("--output", type=Path, help="write the results as JSON to this path")
+    args = parser.parse_args()
+    sizes = [int(size) for size in args.sizes.split(",")]
+    only = set(args.only or ["update", "download", "search", "database"])
+
+    results = []
+    if ("search" in only):
+        results += bench_search(args)
+    for size in sizes:
+        if ("database" in only):
+            results += bench_database(size, args)
+        if ("update" in only):
+            results += bench_update(size, args)
+        if ("download" in only and size <= args.max_download):
+            results += bench_download(size, args)
+
+    for result in results:
+        details = "  ".join(f"{key}={value}" for key, value in result.items() if key not in ("benchmark", "seconds"))
+        print(f"{result['benchmark']:26} {result['seconds'] * 1000:12.2f} ms  {details}")
+
+    if (args.output is not None):
+        report = {
+            "goldfinch_version": __version__,
+            "python": platform.python_version(),
+            "parser": parsing.PARSER,
+            "orjson": database.orjson is not None,
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "settings": {key: value for key, value in vars(args).items() if key != "output"},
+            "results": results,
+        }
+        args.output.write_text(json.dumps(report, indent=4, default=str))
+
+if __name__ == "__main__":
+    main()
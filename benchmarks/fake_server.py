@@ -0,0 +1,182 @@
+# benchmarks/fake_server.py
+
+"""A local stand-in for libgen.is, its mirrors and a Goodreads shelf, so goldfinch can be measured without a network.
+
+    python benchmarks/fake_server.py --books 1000 --latency 0.05 --failure-rate 0.1 --rate-limit 20
+
+Routes:
+    /fiction/?q=...          fiction search results, /search.php?req=... nonfiction search results
+    /fiction/<md5>, /main/<md5>   mirror pages with div#download
+    /file/<md5>              a synthetic epub, honouring Range requests
+    /review/list/1?page=&per_page=   the shelf, newest first
+"""
+
+import argparse
+import random
+import re
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import fixtures
+
+BOOK_PATTERN = re.compile(r"Synthetic Book (\d+)")
+SHELF_PATH = "/review/list/1"
+
+class FakeServer:
+    def __init__(self, books: int = 100, latency: float = 0.0, failure_rate: float = 0.0,
+                 file_size: int = 256 * 1024, search_rows: int = 25, seed: int = 0, rate_limit: float = 0.0) -> None:
+        self.books = [fixtures.book(index) for index in range(books)]
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.file_size = file_size
+        self.search_rows = search_rows
+        self.random = random.Random(seed)
+        self.requests = 0
+        self.throttled = 0
+        #Requests per second answered before the server starts sending 429s, 0 for no limit
+        self.rate_limit = rate_limit
+        self._allowance = rate_limit
+        self._allowance_updated = time.monotonic()
+        self._lock = threading.Lock()
+        self._payloads = {}
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self._server.server_address[1]}"
+
+    @property
+    def shelf_url(self) -> str:
+        return f"{self.base_url}{SHELF_PATH}?shelf=to-read"
+
+    def start(self) -> "FakeServer":
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self) -> "FakeServer":
+        return self.start()
+
+    def __exit__(self, *exc_info) -> None:
+        self.stop()
+
+    def _should_fail(self) -> bool:
+        with self._lock:
+            self.requests += 1
+            return self.random.random() < self.failure_rate
+
+    def _should_throttle(self) -> bool:
+        """a one second token bucket, like the limits real hosts put on bursts"""
+        if (not self.rate_limit):
+            return False
+        with self._lock:
+            now = time.monotonic()
+            self._allowance = min(self.rate_limit, self._allowance + (now - self._allowance_updated) * self.rate_limit)
+            self._allowance_updated = now
+            if (self._allowance < 1):
+                self.throttled += 1
+                return True
+            self._allowance -= 1
+            return False
+
+    def _payload(self, md5: str) -> bytes:
+        with self._lock:
+            if (md5 not in self._payloads):
+                self._payloads[md5] = fixtures.epub_payload(self.file_size, md5)
+            return self._payloads[md5]
+
+    def _search_page(self, query: str, fiction: bool) -> str:
+        match = BOOK_PATTERN.search(query)
+        if (match is None or int(match.group(1)) >= len(self.books)):
+            #Author-only searches and unknown books return nothing useful
+            return fixtures.libgen_empty_page()
+        title = self.books[int(match.group(1))]["title"]
+        if (fiction):
+            return fixtures.libgen_fiction_page(title, self.search_rows, self.base_url)
+        return fixtures.libgen_nonfiction_page(title, self.search_rows, self.base_url)
+
+    def _handler(self) -> type:
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args) -> None:
+                pass
+
+            def _send(self, status: int, body: bytes, headers: dict = None) -> None:
+                self.send_response(status)
+                self.send_header("Content-Length", str(len(body)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self) -> None:
+                if (server.latency):
+                    time.sleep(server.latency)
+                if (server._should_throttle()):
+                    self._send(429, b"Too Many Requests", {"Retry-After": "1"})
+                    return
+                if (server._should_fail()):
+                    self._send(503, b"Service Unavailable")
+                    return
+                url = urllib.parse.urlsplit(self.path)
+                query = dict(urllib.parse.parse_qsl(url.query))
+                if (url.path == "/fiction/"):
+                    self._send(200, server._search_page(query.get("q", ""), True).encode())
+                elif (url.path == "/search.php"):
+                    self._send(200, server._search_page(query.get("req", ""), False).encode())
+                elif (url.path.startswith(("/fiction/", "/main/"))):
+                    md5 = url.path.rsplit("/", 1)[1]
+                    self._send(200, fixtures.libgen_mirror_page(f"{server.base_url}/file/{md5}").encode())
+                elif (url.path.startswith("/file/")):
+                    self._send_file(server._payload(url.path.rsplit("/", 1)[1]))
+                elif (url.path == SHELF_PATH):
+                    page, per_page = int(query.get("page", 1)), int(query.get("per_page", 30))
+                    self._send(200, fixtures.goodreads_shelf_page(server.books, page, per_page).encode())
+                else:
+                    self._send(404, b"Not Found")
+
+            def _send_file(self, payload: bytes) -> None:
+                range_header = self.headers.get("Range")
+                if (range_header is None):
+                    self._send(200, payload, {"Content-Type": "application/epub+zip"})
+                    return
+                start = int(range_header.split("=")[1].split("-")[0])
+                if (start >= len(payload)):
+                    self._send(416, b"")
+                    return
+                self._send(206, payload[start:], {
+                    "Content-Type": "application/epub+zip",
+                    "Content-Range": f"bytes {start}-{len(payload) - 1}/{len(payload)}",
+                })
+
+        return Handler
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--books", type=int, default=100)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every response")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="fraction of requests answered with 503")
+    parser.add_argument("--file-size", type=int, default=256 * 1024)
+    parser.add_argument("--rate-limit", type=float, default=0.0, help="requests per second before answering 429")
+    args = parser.parse_args()
+    server = FakeServer(args.books, args.latency, args.failure_rate, args.file_size, rate_limit=args.rate_limit).start()
+    print(f"libgen_url = {server.base_url}")
+    print(f"goodreads_url = {server.shelf_url}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.stop()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+# benchmarks/fixtures.py
+
+"""HTML pages shaped like the libgen and Goodreads pages goldfinch parses."""
+
+from datetime import date, timedelta
+import hashlib
+import html
+import io
+import zipfile
+
+BASE_DATE = date(2024, 1, 1)
+
+def md5(seed: str) -> str:
+    return hashlib.md5(seed.encode()).hexdigest().upper()
+
+def book(index: int) -> dict:
+    """the index-th synthetic book, stable across runs"""
+    return {
+        "title": f"Synthetic Book {index}",
+        "author": f"Author{index % 997} Writer",
+        "date_added": BASE_DATE - timedelta(days=index // 10),
+        "md5": md5(f"book-{index}"),
+    }
+
+def _page(body: str) -> str:
+    head = "<head><title>Library Genesis</title>" + "<script>var x = 1;</script>" * 20 + "</head>"
+    nav = "<div id=\"menu\">" + "".join(f"<a href=\"/m{i}\">menu {i}</a>" for i in range(60)) + "</div>"
+    return f"<!DOCTYPE html><html>{head}<body>{nav}{body}</body></html>"
+
+def libgen_fiction_page(title: str, rows: int = 25, base_url: str = "http://library.lol") -> str:
+    """a libgen.is/fiction search result page with rows results, every other one matching title"""
+    items = []
+    for i in range(rows):
+        item_title = title if i % 2 == 0 else f"Another Book {i}"
+        item_md5 = md5(f"{title}-fiction-{i}")
+        mirrors = "".join(
+            f"<li><a href=\"{base_url}/fiction/{item_md5}\" title=\"mirror {m}\">[{m}]</a></li>" for m in range(1, 4)
+        )
+        items.append(
+            "<tr>"
+            f"<td><ul class=\"catalog_authors\"><li><a href=\"/fiction/?q=a{i}\">Author {i}</a></li></ul></td>"
+            f"<td>Series {i}</td>"
+            f"<td><p><a href=\"/fiction/{item_md5}\">{html.escape(item_title)}</a></p><p class=\"catalog_identifier\">ISBN: 97800000{i:05d}</p></td>"
+            "<td>English</td>"
+            f"<td title=\"Uploaded at 2020-01-01\">EPUB / {(i % 9) + 1}.{i % 10} Mb</td>"
+            f"<td><ul class=\"record_mirrors_compact\">{mirrors}</ul></td>"
+            f"<td><a href=\"/fiction/edit/{item_md5}\">edit</a></td>"
+            "</tr>"
+        )
+    header = "<thead><tr><td>Author(s)</td><td>Series</td><td>Title</td><td>Language</td><td>File</td><td>Mirrors</td><td></td></tr></thead>"
+    return _page(f"<table class=\"catalog\">{header}<tbody>{''.join(items)}</tbody></table>")
+
+def libgen_nonfiction_page(title: str, rows: int = 100, base_url: str = "http://library.lol") -> str:
+    """a libgen.is/search.php result page in simple view with rows results"""
+    items = []
+    for i in range(rows):
+        item_title = title if i % 2 == 0 else f"Another Book {i}"
+        item_md5 = md5(f"{title}-nonfiction-{i}")
+        items.append(
+            "<tr valign=top bgcolor=\"\">"
+            f"<td>{i}</td>"
+            f"<td><a href=\"search.php?req=a{i}&column=author\">Author {i}</a></td>"
+            f"<td width=500><a href=\"book/index.php?md5={item_md5}\" title=\"\" id={i}>{html.escape(item_title)}</a></td>"
+            "<td>Publisher</td><td>2001</td><td>320</td><td>English</td>"
+            f"<td nowrap>{(i % 40) + 1} Mb</td><td nowrap>{'pdf' if i % 3 else 'epub'}</td>"
+            f"<td><a href=\"{base_url}/main/{item_md5}\" title=\"this mirror\">[1]</a></td>"
+            f"<td><a href=\"http://mirror2.example/{item_md5}\" title=\"Libgen.pw\">[2]</a></td>"
+            f"<td><a href=\"http://libgen.is/book/edit.php?md5={item_md5}\">[edit]</a></td>"
+            "</tr>"
+        )
+    header = "<tr valign=top bgcolor=#C0C0C0><td><b>ID</b></td><td><b>Author(s)</b></td><td><b>Title</b></td><td><b>Publisher</b></td><td><b>Year</b></td><td><b>Pages</b></td><td><b>Language</b></td><td><b>Size</b></td><td><b>Extension</b></td><td colspan=2><b>Mirrors</b></td><td><b>Edit</b></td></tr>"
+    return _page(f"<table width=100% cellspacing=1 cellpadding=1 rules=rows class=c align=center>{header}{''.join(items)}</table>")
+
+def libgen_empty_page() -> str:
+    return _page("<p>No files were found.</p>")
+
+def libgen_mirror_page(file_url: str) -> str:
+    """a mirror page linking to the file in div#download"""
+    return _page(f"<div id=\"info\"><h1>Book</h1></div><div id=\"download\"><h2><a href=\"{file_url}\">GET</a></h2><ul><li><a href=\"{file_url}?alt\">Cloudflare</a></li></ul></div>")
+
+def epub_payload(size: int, seed: str = "") -> bytes:
+    """a valid epub of about size bytes, a zip with the uncompressed mimetype entry first"""
+    buffer = io.BytesIO()
+    block = hashlib.sha256(seed.encode()).digest()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_STORED) as archive:
+        #A fixed timestamp keeps the bytes, and so Range requests, stable across runs
+        archive.writestr(zipfile.ZipInfo("mimetype", date_time=(2020, 1, 1, 0, 0, 0)), "application/epub+zip")
+        archive.writestr(zipfile.ZipInfo("OEBPS/content.bin", date_time=(2020, 1, 1, 0, 0, 0)),
+                         (block * (size // len(block) + 1))[:max(size - 250, 0)])
+    return buffer.getvalue()
+
+def goodreads_shelf_page(books: list, page: int, per_page: int) -> str:
+    """one page of a Goodreads review/list shelf, newest date_added first"""
+    last_page = max(1, (len(books) + per_page - 1) // per_page)
+    rows = []
+    for index, item in enumerate(books[(page - 1) * per_page:page * per_page], start=(page - 1) * per_page):
+        added = item["date_added"].strftime("%b %d, %Y").replace(" 0", " ")
+        rows.append(
+            f"<tr id=\"review_{index}\" class=\"bookalike review\">"
+            "<td class=\"field checkbox\"><label>checkbox</label><div class=\"value\"><input type=\"checkbox\"></div></td>"
+            f"<td class=\"field cover\"><label>cover</label><div class=\"value\"><img src=\"/c/{index}.jpg\"></div></td>"
+            f"<td class=\"field title\"><label>title</label><div class=\"value\">\n<a title=\"{html.escape(item['title'])}\" href=\"/book/show/{index}\">\n{html.escape(item['title'])}\n</a></div></td>"
+            f"<td class=\"field author\"><label>author</label><div class=\"value\">\n<a href=\"/author/show/{index}\">{html.escape(item['author'])}</a>\n</div></td>"
+            f"<td class=\"field isbn\"><label>isbn</label><div class=\"value\">97800000{index:05d}</div></td>"
+            "<td class=\"field rating\"><label>avg rating</label><div class=\"value\">4.01</div></td>"
+            f"<td class=\"field date_added\"><label>date added</label><div class=\"value\">\n<span title=\"{added}\">\n{added}\n</span></div></td>"
+            "</tr>"
+        )
+    links = "".join(f"<a href=\"?page={p}\">{p}</a>" for p in range(1, last_page + 1))
+    pagination = f"<div id=\"reviewPagination\">{links}<a class=\"next_page\" rel=\"next\">next »</a></div>"
+    table = f"<table id=\"books\"><thead><tr><th>title</th></tr></thead><tbody id=\"booksBody\">{''.join(rows)}</tbody></table>"
+    return _page(table + pagination)
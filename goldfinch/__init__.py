@@ -13,8 +13,9 @@ __version__ = '0.1.0'
     DOWNLOAD_ERROR,
     NO_RESULTS,
     NOT_IN_DB,
-    CANT_REACH_LIBGEN
-) = range(10)
+    CANT_REACH_LIBGEN,
+    NO_SHELF
+) = range(11)
 
 ERRORS = {
     SUCCESS : "No errors",
@@ -26,5 +27,6 @@ ERRORS = {
     DOWNLOAD_ERROR : "Download error",
     NO_RESULTS : "no results found on libgen.is",
     NOT_IN_DB : "book not in database",
-    CANT_REACH_LIBGEN : "can't reach libgen.is. Is your vpn on?"
+    CANT_REACH_LIBGEN : "can't reach libgen.is. Is your vpn on?",
+    NO_SHELF : "no such shelf in the config file"
 }
\ No newline at end of file
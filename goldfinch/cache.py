@@ -0,0 +1,99 @@
+# goldfinch/cache.py
+
+import json
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, List, NamedTuple, Optional
+
+from config import DEFAULT_CACHE_PATH, DEFAULT_CACHE_TTL_HOURS, DEFAULT_CACHE_NEGATIVE_TTL_HOURS, DEFAULT_CACHE_MAX_MB
+from __init__ import SUCCESS
+
+class CachedSearch(NamedTuple):
+    results: List[Dict[str, Any]]
+    error: int
+
+class SearchCache:
+    """persistent cache of parsed libgen search results, expired by age and evicted least recently used first"""
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS search_results (
+            key TEXT PRIMARY KEY,
+            results TEXT NOT NULL,
+            error INTEGER NOT NULL,
+            created REAL NOT NULL,
+            accessed REAL NOT NULL,
+            size INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS search_results_accessed ON search_results (accessed);
+    """
+
+    def __init__(
+        self,
+        cache_path: Path = DEFAULT_CACHE_PATH,
+        ttl_hours: float = DEFAULT_CACHE_TTL_HOURS,
+        negative_ttl_hours: float = DEFAULT_CACHE_NEGATIVE_TTL_HOURS,
+        max_mb: float = DEFAULT_CACHE_MAX_MB,
+    ) -> None:
+        self.cache_path = cache_path
+        self.ttl = ttl_hours * 3600
+        self.negative_ttl = negative_ttl_hours * 3600
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self._connection = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(title: str, author: str, criteria: int, locale: int) -> str:
+        return json.dumps([title, author, criteria, locale])
+
+    def _connect(self) -> sqlite3.Connection:
+        if (self._connection is None):
+            self._connection = sqlite3.connect(self.cache_path, check_same_thread=False)
+            self._connection.executescript(SearchCache.SCHEMA)
+        return self._connection
+
+    def get(self, key: str) -> Optional[CachedSearch]:
+        """return the cached search for key, or None if it is missing or expired"""
+        now = time.time()
+        try:
+            with self._lock:
+                connection = self._connect()
+                row = connection.execute("SELECT results, error, created FROM search_results WHERE key = ?", (key,)).fetchone()
+                if (row is None): return None
+                results, error, created = row
+                ttl = self.ttl if error == SUCCESS else self.negative_ttl
+                if (now - created > ttl):
+                    with connection:
+                        connection.execute("DELETE FROM search_results WHERE key = ?", (key,))
+                    return None
+                with connection:
+                    connection.execute("UPDATE search_results SET accessed = ? WHERE key = ?", (now, key))
+        except sqlite3.Error:
+            #A broken cache only costs a network request
+            return None
+        return CachedSearch(json.loads(results), error)
+
+    def put(self, key: str, results: List[Dict[str, Any]], error: int) -> None:
+        now = time.time()
+        encoded = json.dumps(results)
+        size = len(key) + len(encoded)
+        try:
+            with self._lock:
+                connection = self._connect()
+                with connection:
+                    connection.execute(
+                        "INSERT OR REPLACE INTO search_results VALUES (?, ?, ?, ?, ?, ?)",
+                        (key, encoded, error, now, now, size)
+                    )
+                    self._evict(connection)
+        except sqlite3.Error:
+            pass
+
+    def _evict(self, connection: sqlite3.Connection) -> None:
+        """drop the least recently used searches until the cache fits in max_bytes"""
+        total = connection.execute("SELECT COALESCE(SUM(size), 0) FROM search_results").fetchone()[0]
+        if (total <= self.max_bytes): return
+        for key, size in connection.execute("SELECT key, size FROM search_results ORDER BY accessed").fetchall():
+            connection.execute("DELETE FROM search_results WHERE key = ?", (key,))
+            total -= size
+            if (total <= self.max_bytes): break
@@ -3,12 +3,19 @@
 from typing import Optional
 from typing_extensions import Annotated
 
+import signal
 import typer
+from datetime import datetime
 from pathlib import Path
 
-from __init__ import __version__, __app_name__, ERRORS
+from __init__ import __version__, __app_name__, ERRORS, FILE_ERROR
 from database import DEFAULT_DB_PATH, DEFAULT_DATE_SINCE_UPDATE
-from downloader import init_downloads_dir, DEFAULT_DOWNLOADS_DIR
+from http_client import HTTPClient, RateLimiter
+from cache import SearchCache
+from metrics import METRICS
+from mirrors import MirrorHealth
+from config import init_downloads_dir, DEFAULT_DOWNLOADS_DIR
+from listing import OUTPUT_FORMATS
 import config
 import database
 import goldfinch
@@ -51,18 +58,92 @@ def init(
     raise typer.Exit(1)
 
 
+def get_db_format(config_parser) -> str:
+    db_format = config_parser.get("General", "database_format", fallback=config.DEFAULT_DATABASE_FORMAT)
+    if (db_format not in database.DB_FORMATS):
+        typer.secho(f"database_format in the config file must be one of: {", ".join(database.DB_FORMATS)}", fg=typer.colors.RED)
+        raise typer.Exit(1)
+    return db_format
+
 def get_goldfinch() -> goldfinch.Goldfinch:
     config_parser = config.get_config_parser()
     db_path = Path(config_parser["General"]["database_path"])
     gr_url = config_parser["General"]["goodreads_url"]
     downloads_path = Path(config_parser["General"]["downloads_path"])
-    return goldfinch.Goldfinch(db_path, gr_url, downloads_path)
+    workers = config_parser.getint("Download", "workers", fallback=config.DEFAULT_WORKERS)
+    max_per_host = config_parser.getint("Download", "max_per_host", fallback=config.DEFAULT_MAX_PER_HOST)
+    search_workers = config_parser.getint("Download", "search_workers", fallback=config.DEFAULT_SEARCH_WORKERS)
+    libgen_url = config_parser.get("Download", "libgen_url", fallback=config.DEFAULT_LIBGEN_URL)
+    http_client = HTTPClient(
+        timeout=config_parser.getfloat("HTTP", "timeout", fallback=config.DEFAULT_HTTP_TIMEOUT),
+        retries=config_parser.getint("HTTP", "retries", fallback=config.DEFAULT_HTTP_RETRIES),
+        backoff_factor=config_parser.getfloat("HTTP", "backoff_factor", fallback=config.DEFAULT_HTTP_BACKOFF_FACTOR),
+        max_connections_per_host=config_parser.getint("HTTP", "connections_per_host", fallback=config.DEFAULT_HTTP_CONNECTIONS_PER_HOST),
+        rate_limiter=RateLimiter(
+            requests_per_second=config_parser.getfloat("HTTP", "requests_per_second", fallback=config.DEFAULT_HTTP_REQUESTS_PER_SECOND),
+            burst=config_parser.getint("HTTP", "burst", fallback=config.DEFAULT_HTTP_BURST),
+            host_rates={host: float(rate) for host, rate in config_parser.items("RateLimits")} if config_parser.has_section("RateLimits") else {},
+        ),
+        max_retry_after=config_parser.getfloat("HTTP", "max_retry_after", fallback=config.DEFAULT_HTTP_MAX_RETRY_AFTER),
+    )
+    gr_per_page = config_parser.getint("Goodreads", "per_page", fallback=config.DEFAULT_GR_PER_PAGE)
+    gr_page_workers = config_parser.getint("Goodreads", "page_workers", fallback=config.DEFAULT_GR_PAGE_WORKERS)
+    search_cache = None
+    if config_parser.getboolean("Cache", "enabled", fallback=True):
+        search_cache = SearchCache(
+            cache_path=Path(config_parser.get("Cache", "path", fallback=str(config.DEFAULT_CACHE_PATH))),
+            ttl_hours=config_parser.getfloat("Cache", "ttl_hours", fallback=config.DEFAULT_CACHE_TTL_HOURS),
+            negative_ttl_hours=config_parser.getfloat("Cache", "negative_ttl_hours", fallback=config.DEFAULT_CACHE_NEGATIVE_TTL_HOURS),
+            max_mb=config_parser.getfloat("Cache", "max_mb", fallback=config.DEFAULT_CACHE_MAX_MB),
+        )
+    mirror_health = MirrorHealth(
+        path=Path(config_parser.get("Mirrors", "health_path", fallback=str(config.DEFAULT_MIRROR_HEALTH_PATH))),
+        failure_threshold=config_parser.getint("Mirrors", "failure_threshold", fallback=config.DEFAULT_MIRROR_FAILURE_THRESHOLD),
+        cooldown_minutes=config_parser.getfloat("Mirrors", "cooldown_minutes", fallback=config.DEFAULT_MIRROR_COOLDOWN_MINUTES),
+    )
+    return goldfinch.Goldfinch(
+        db_path, gr_url, downloads_path,
+        workers=workers,
+        max_per_host=max_per_host,
+        http_client=http_client,
+        gr_per_page=gr_per_page,
+        gr_page_workers=gr_page_workers,
+        search_cache=search_cache,
+        search_workers=search_workers,
+        libgen_url=libgen_url,
+        mirror_health=mirror_health,
+        shelves=config.get_shelves(config_parser),
+        retry_backoff_hours=config_parser.getfloat("Download", "retry_backoff_hours", fallback=config.DEFAULT_RETRY_BACKOFF_HOURS),
+        max_retry_backoff_hours=config_parser.getfloat("Download", "max_retry_backoff_hours", fallback=config.DEFAULT_MAX_RETRY_BACKOFF_HOURS),
+        db_format=get_db_format(config_parser),
+    )
+
+def report_metrics(metrics_json: Optional[Path], prometheus: Optional[Path]) -> None:
+    """print the run summary and write the metrics files that were asked for"""
+    typer.secho("Run summary", fg=typer.colors.GREEN)
+    for line in METRICS.summary():
+        typer.secho(line, fg=typer.colors.WHITE)
+    prometheus = prometheus or config.get_config_parser().get("Metrics", "prometheus_path", fallback=None)
+    try:
+        if metrics_json:
+            METRICS.write_json(Path(metrics_json))
+        if prometheus:
+            METRICS.write_prometheus(Path(prometheus))
+    except OSError:
+        typer.secho(f"writing metrics failed with {ERRORS[FILE_ERROR]}", fg=typer.colors.RED)
+
+MetricsJsonOption = Annotated[Optional[Path], typer.Option("--metrics-json", help="Write the run's timings and counters to this JSON file.")]
+PrometheusOption = Annotated[Optional[Path], typer.Option("--prometheus", help="Write the run's metrics to this Prometheus textfile. Defaults to [Metrics] prometheus_path in the config file.")]
 
 @app.command()
-def update() -> None:
+def update(
+    full: Annotated[bool, typer.Option("--full", "-f", help="Re-read the whole shelf instead of only the books added since the last update.")] = False,
+    metrics_json: MetricsJsonOption = None,
+    prometheus: PrometheusOption = None,
+) -> None:
     """Update the undownloaded database with the books from Goodreads"""
     goldfinch = get_goldfinch()
-    update_error = goldfinch.update_db()
+    update_error = goldfinch.update_db(full)
     if update_error:
         typer.secho(
             f"update failed with {ERRORS[update_error]}",
@@ -70,14 +151,20 @@ def update() -> None:
         )
     typer.secho(f"Database updated",
                 fg=typer.colors.GREEN)
+    report_metrics(metrics_json, prometheus)
 
 @app.command()
 def download(
     retry_failed: Annotated[bool, typer.Option("--retry", "-r", help="Retry failed downloads. Will not download new books.")] = False,
+    workers: Annotated[int, typer.Option("--workers", "-w", min=1, help="Number of books to download concurrently. Defaults to the config file value.")] = None,
+    max_books: Annotated[Optional[int], typer.Option("--max-books", min=1, help="Try at most this many books, highest priority first.")] = None,
+    time_budget: Annotated[Optional[float], typer.Option("--time-budget", min=0, help="Minutes after which no new download is started. Those in progress are finished.")] = None,
+    metrics_json: MetricsJsonOption = None,
+    prometheus: PrometheusOption = None,
 ) -> None:
-    """Download books from the undownloaded database. If --retry is used, only failed downloads will be retried."""
+    """Download books from the undownloaded database, highest priority and newest first. If --retry is used, only failed downloads will be retried, skipping those that failed too recently."""
     goldfinch = get_goldfinch()
-    download_error = goldfinch.download_all(retry_failed)
+    download_error = goldfinch.download_all(retry_failed, workers, max_books=max_books, time_budget_minutes=time_budget)
     if download_error:
         typer.secho(
             f"downloads failed with {ERRORS[download_error]}",
@@ -85,37 +172,127 @@ def download(
         )
     typer.secho(f"Downloads complete",
                 fg=typer.colors.GREEN)
+    report_metrics(metrics_json, prometheus)
+
+@app.command()
+def verify(
+    requeue: Annotated[bool, typer.Option("--requeue", "-r", help="Delete broken files and move their books back to undownloaded.")] = False,
+    workers: Annotated[int, typer.Option("--workers", "-w", min=1, help="Number of files to check concurrently. Defaults to the config file value.")] = None,
+) -> None:
+    """Check that every downloaded file is present, complete and matches its checksum"""
+    goldfinch = get_goldfinch()
+    verify_response = goldfinch.verify(requeue, workers)
+    if verify_response.error:
+        typer.secho(
+            f"verify failed with {ERRORS[verify_response.error]}",
+            fg=typer.colors.RED
+        )
+        raise typer.Exit(1)
+    for key, problem in verify_response.problems.items():
+        typer.secho(f"{key}: {problem}", fg=typer.colors.RED)
+    if (not verify_response.problems):
+        typer.secho(f"All {verify_response.checked} files are intact", fg=typer.colors.GREEN)
+        return
+    typer.secho(f"{len(verify_response.problems)} of {verify_response.checked} files are broken" + (", their books were re-queued" if requeue else ""),
+                fg=typer.colors.YELLOW)
+
+@app.command()
+def watch(
+    interval: Annotated[float, typer.Option("--interval", "-i", min=0, help="Minutes between shelf polls. Defaults to the config file value.")] = None,
+    jitter: Annotated[float, typer.Option("--jitter", min=0, max=1, help="Fraction the interval is randomly varied by. Defaults to the config file value.")] = None,
+    workers: Annotated[int, typer.Option("--workers", "-w", min=1, help="Number of books to download concurrently. Defaults to the config file value.")] = None,
+    metrics_json: MetricsJsonOption = None,
+    prometheus: PrometheusOption = None,
+) -> None:
+    """Keep polling Goodreads and download new books as they are added. Stop with Ctrl+C or SIGTERM."""
+    config_parser = config.get_config_parser()
+    interval = interval if interval is not None else config_parser.getfloat("Watch", "interval_minutes", fallback=config.DEFAULT_WATCH_INTERVAL_MINUTES)
+    jitter = jitter if jitter is not None else config_parser.getfloat("Watch", "jitter", fallback=config.DEFAULT_WATCH_JITTER)
+    goldfinch = get_goldfinch()
+
+    def stop(signum, frame) -> None:
+        typer.secho("Stopping once the books in progress are done", fg=typer.colors.YELLOW)
+        goldfinch.stop()
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    typer.secho(f"Watching the shelf every {interval:g} minutes", fg=typer.colors.GREEN)
+    watch_error = goldfinch.watch(interval, jitter, workers)
+    if watch_error:
+        typer.secho(
+            f"watch failed with {ERRORS[watch_error]}",
+            fg=typer.colors.RED
+        )
+    typer.secho(f"Watch stopped",
+                fg=typer.colors.GREEN)
+    report_metrics(metrics_json, prometheus)
+
+def parse_list_date(value: Optional[str], option: str) -> Optional[str]:
+    if (value is None): return None
+    try:
+        return datetime.strptime(value, "%m-%d-%Y").strftime("%Y-%m-%d")
+    except ValueError:
+        typer.secho(f"{option} must be in the form MM-DD-YYYY", fg=typer.colors.RED)
+        raise typer.Exit(1)
 
 @app.command()
 def list(
     downloaded: Annotated[bool, typer.Option("--downloaded", "-d", help="List downloaded books.")] = False,
     undownloaded: Annotated[bool, typer.Option("--undownloaded", "-u", help="List undownloaded books.")] = False,
     failed: Annotated[bool, typer.Option("--failed", "-f", help="List failed downloads.")] = False,
+    title: Annotated[Optional[str], typer.Option("--title", help="Only books whose title contains this, ignoring case.")] = None,
+    author: Annotated[Optional[str], typer.Option("--author", help="Only books whose author contains this, ignoring case.")] = None,
+    owner: Annotated[Optional[str], typer.Option("--owner", help="Only books on this shelf, by the name it has in the config file.")] = None,
+    since: Annotated[Optional[str], typer.Option("--since", help="Only books added on or after this date\nin the form MM-DD-YYYY")] = None,
+    until: Annotated[Optional[str], typer.Option("--until", help="Only books added on or before this date\nin the form MM-DD-YYYY")] = None,
+    sort: Annotated[Optional[str], typer.Option("--sort", help=f"Sort by one of: {", ".join(database.SORT_FIELDS)}.")] = None,
+    reverse: Annotated[bool, typer.Option("--reverse", help="Reverse the order.")] = False,
+    limit: Annotated[Optional[int], typer.Option("--limit", min=0, help="List at most this many books.")] = None,
+    offset: Annotated[int, typer.Option("--offset", min=0, help="Skip this many books first.")] = 0,
+    output_format: Annotated[str, typer.Option("--format", help=f"Output format, one of: {", ".join(OUTPUT_FORMATS)}.")] = "text",
+    count: Annotated[bool, typer.Option("--count", help="Only print how many books match.")] = False,
 ) -> None:
-    """List books in the database. Only one of --downloaded, --undownloaded, or --failed can be used at a time."""
-    if (downloaded and undownloaded) or (downloaded and failed) or (undownloaded and failed):
-        typer.secho(
-            "Only one of --downloaded, --undownloaded, or --failed can be used at a time",
-            fg=typer.colors.RED
-        )
+    """List books in the database. --downloaded, --undownloaded and --failed can be combined, by default all books are listed."""
+    if (sort is not None and sort not in database.SORT_FIELDS):
+        typer.secho(f"--sort must be one of: {", ".join(database.SORT_FIELDS)}", fg=typer.colors.RED)
+        raise typer.Exit(1)
+    if (output_format not in OUTPUT_FORMATS):
+        typer.secho(f"--format must be one of: {", ".join(OUTPUT_FORMATS)}", fg=typer.colors.RED)
         raise typer.Exit(1)
+    chosen = {"undownloaded_books": undownloaded, "downloaded_books": downloaded, "failed_books": failed}
+    buckets = tuple(bucket for bucket, wanted in chosen.items() if wanted) or tuple(chosen)
+    query = database.BookQuery(
+        buckets=buckets,
+        title=title,
+        author=author,
+        owner=owner,
+        added_after=parse_list_date(since, "--since"),
+        added_before=parse_list_date(until, "--until"),
+        sort=sort,
+        descending=reverse,
+        limit=limit,
+        offset=offset,
+    )
     goldfinch = get_goldfinch()
-    source = "downloaded_books" if downloaded else "undownloaded_books" if undownloaded else "failed_books" if failed else None
-    list_error = goldfinch.list(source)
+    list_error = goldfinch.list(query, output_format, count)
     if list_error:
         typer.secho(
             f"list failed with {ERRORS[list_error]}",
             fg=typer.colors.RED
         )
+        raise typer.Exit(1)
 
 @app.command()
 def add(
     title: Annotated[str, typer.Argument(help="title of the book")],
     author: Annotated[str, typer.Argument(help="author of the book")],
     date_added: Annotated[str, typer.Option("--date", help="date added to the database\nin the form MM-DD-YYYY")] = None,
-    destination: Annotated[str, typer.Option("--destination", "-d", help="destination of the book: undownloaded_books, downloaded_books, failed_books")] = "undownloaded_books"
+    destination: Annotated[str, typer.Option("--destination", "-d", help="destination of the book: undownloaded_books, downloaded_books, failed_books\ndefaults to undownloaded_books, or where the book already is")] = None
 ) -> None:
     """Add a book to the database"""
+    if (destination is not None and destination not in database.BUCKETS):
+        typer.secho(f"--destination must be one of: {", ".join(database.BUCKETS)}", fg=typer.colors.RED)
+        raise typer.Exit(1)
     goldfinch = get_goldfinch()
     add_error = goldfinch.add_book(title, author, date_added, destination)
     if add_error:
@@ -128,12 +305,69 @@ def add(
                 fg=typer.colors.GREEN)
 
 @app.command()
-def remove(
+def priority(
     title: Annotated[str, typer.Argument(help="title of the book")],
-    author: Annotated[str, typer.Argument(help="author of the book")]
+    author: Annotated[str, typer.Argument(help="author of the book")],
+    value: Annotated[int, typer.Argument(help="higher is downloaded first, books start at 0")],
 ) -> None:
-    """Remove a book from the database"""
+    """Set how early a book is downloaded or retried"""
     goldfinch = get_goldfinch()
+    priority_error = goldfinch.set_priority(title, author, value)
+    if priority_error:
+        typer.secho(
+            f"priority failed with {ERRORS[priority_error]}",
+            fg=typer.colors.RED
+        )
+        raise typer.Exit(1)
+    typer.secho(f"Priority set",
+                fg=typer.colors.GREEN)
+
+@app.command("import")
+def import_books(
+    path: Annotated[Path, typer.Argument(help="CSV or JSONL file of books, e.g. a Goodreads library export")],
+    destination: Annotated[str, typer.Option("--destination", "-d", help="destination of the books: undownloaded_books, downloaded_books, failed_books")] = "undownloaded_books",
+    shelf: Annotated[str, typer.Option("--shelf", help="only import rows on this shelf, e.g. to-read")] = None,
+) -> None:
+    """Add every book in a CSV or JSONL file to the database. Rows need a title and an author column."""
+    if (destination not in database.BUCKETS):
+        typer.secho(f"--destination must be one of: {", ".join(database.BUCKETS)}", fg=typer.colors.RED)
+        raise typer.Exit(1)
+    goldfinch = get_goldfinch()
+    import_response = goldfinch.import_books(path, destination, shelf)
+    if import_response.error:
+        typer.secho(
+            f"import failed with {ERRORS[import_response.error]}",
+            fg=typer.colors.RED
+        )
+        raise typer.Exit(1)
+    typer.secho(f"{import_response.added} books added, {import_response.duplicates} already in the database, {import_response.skipped} rows skipped",
+                fg=typer.colors.GREEN)
+
+@app.command()
+def remove(
+    title: Annotated[Optional[str], typer.Argument(help="title of the book")] = None,
+    author: Annotated[Optional[str], typer.Argument(help="author of the book")] = None,
+    from_file: Annotated[Optional[Path], typer.Option("--from-file", help="remove every book in this CSV or JSONL file instead")] = None,
+) -> None:
+    """Remove a book, or every book listed in a file, from the database"""
+    if (from_file is None and (title is None or author is None)):
+        typer.secho(
+            "Give a title and an author, or --from-file",
+            fg=typer.colors.RED
+        )
+        raise typer.Exit(1)
+    goldfinch = get_goldfinch()
+    if (from_file is not None):
+        remove_response = goldfinch.remove_books(from_file)
+        if remove_response.error:
+            typer.secho(
+                f"remove failed with {ERRORS[remove_response.error]}",
+                fg=typer.colors.RED
+            )
+            raise typer.Exit(1)
+        typer.secho(f"{remove_response.removed} books removed, {remove_response.missing} not in the database",
+                    fg=typer.colors.GREEN)
+        return
     remove_error = goldfinch.remove_book(title, author)
     if remove_error:
         typer.secho(
@@ -157,6 +391,63 @@ def url(
     url = goldfinch.get_gr_url()
     typer.secho(f"Goodreads url: {url}")
 
+@app.command()
+def shelves(
+    add: Annotated[Optional[str], typer.Option("--add", help="Name of a shelf to add, e.g. the Goodreads user it belongs to. Needs --url.")] = None,
+    shelf_url: Annotated[Optional[str], typer.Option("--url", help="Goodreads shelf URL of the shelf to add")] = None,
+    remove: Annotated[Optional[str], typer.Option("--remove", help="Name of a shelf to stop syncing. Its books stay in the database.")] = None,
+) -> None:
+    """List the shelves that update and watch sync, or add and remove them. Books on several shelves are downloaded once."""
+    if (add is not None):
+        if (shelf_url is None or add == config.DEFAULT_SHELF):
+            typer.secho(f"--add needs --url, and a name other than {config.DEFAULT_SHELF}", fg=typer.colors.RED)
+            raise typer.Exit(1)
+        add_error = config.add_shelf(add, shelf_url)
+        if add_error:
+            typer.secho(
+                f"adding shelf failed with {ERRORS[add_error]}",
+                fg=typer.colors.RED
+            )
+            raise typer.Exit(1)
+        typer.secho(f"Shelf {add} added", fg=typer.colors.GREEN)
+        return
+    if (remove is not None):
+        remove_error = config.remove_shelf(remove)
+        if remove_error:
+            typer.secho(
+                f"removing shelf failed with {ERRORS[remove_error]}",
+                fg=typer.colors.RED
+            )
+            raise typer.Exit(1)
+        typer.secho(f"Shelf {remove} removed", fg=typer.colors.GREEN)
+        return
+    for name, shelf in config.get_shelves(config.get_config_parser()).items():
+        typer.secho(f"{name}: {shelf}", fg=typer.colors.WHITE)
+
+@app.command()
+def migrate(
+    new_db_path: Annotated[str, typer.Argument(help="path to the new database, a .db or .sqlite path uses SQLite storage")],
+) -> None:
+    """Copy the database to a new path and storage format, then point the config file at it"""
+    config_parser = config.get_config_parser()
+    db_path = Path(config_parser["General"]["database_path"])
+    migrate_error = database.migrate_database(db_path, Path(new_db_path), get_db_format(config_parser))
+    if migrate_error:
+        typer.secho(
+            f"migrate failed with {ERRORS[migrate_error]}",
+            fg=typer.colors.RED
+        )
+        raise typer.Exit(1)
+    config_error = config.set_database_path(new_db_path)
+    if config_error:
+        typer.secho(
+            f"updating config file failed with {ERRORS[config_error]}",
+            fg=typer.colors.RED
+        )
+        raise typer.Exit(1)
+    typer.secho(f"Database migrated to {new_db_path}",
+                fg=typer.colors.GREEN)
+
 @app.command()
 def cfig() -> None:
     path = config.get_config_path()
@@ -1,11 +1,42 @@
 import configparser
 from pathlib import Path
+from typing import Dict
 import typer
 
-from __init__ import __app_name__, SUCCESS, DIR_ERROR, FILE_ERROR, DB_ERROR
+from __init__ import __app_name__, SUCCESS, DIR_ERROR, FILE_ERROR, DB_ERROR, DOWNLOAD_ERROR, NO_SHELF
 
 CONFIG_DIR_PATH = Path(typer.get_app_dir(__app_name__))
 CONFIG_FILE_PATH = CONFIG_DIR_PATH / "config.ini"
+DEFAULT_DOWNLOADS_DIR = Path.home() / "goldfinch_book_downloads"
+DEFAULT_LIBGEN_URL = "https://libgen.is"
+DEFAULT_DATABASE_FORMAT = "compact"
+DEFAULT_WORKERS = 4
+DEFAULT_MAX_PER_HOST = 2
+DEFAULT_SEARCH_WORKERS = 6
+#A book that failed n times waits backoff * 2^(n-1) hours, up to the max, before --retry tries it again
+DEFAULT_RETRY_BACKOFF_HOURS = 6.0
+DEFAULT_MAX_RETRY_BACKOFF_HOURS = 720.0
+DEFAULT_HTTP_TIMEOUT = 30.0
+DEFAULT_HTTP_RETRIES = 3
+DEFAULT_HTTP_BACKOFF_FACTOR = 0.5
+DEFAULT_HTTP_CONNECTIONS_PER_HOST = 4
+DEFAULT_HTTP_REQUESTS_PER_SECOND = 4.0
+DEFAULT_HTTP_BURST = 8
+DEFAULT_HTTP_MAX_RETRY_AFTER = 120.0
+DEFAULT_GR_PER_PAGE = 100
+DEFAULT_GR_PAGE_WORKERS = 4
+DEFAULT_CACHE_PATH = CONFIG_DIR_PATH / "search_cache.sqlite"
+DEFAULT_CACHE_TTL_HOURS = 168.0
+DEFAULT_CACHE_NEGATIVE_TTL_HOURS = 24.0
+DEFAULT_CACHE_MAX_MB = 16.0
+DEFAULT_MIRROR_HEALTH_PATH = CONFIG_DIR_PATH / "mirror_health.json"
+DEFAULT_MIRROR_FAILURE_THRESHOLD = 3
+DEFAULT_MIRROR_COOLDOWN_MINUTES = 60.0
+DEFAULT_WATCH_INTERVAL_MINUTES = 15.0
+DEFAULT_WATCH_JITTER = 0.1
+#The shelf in [General] goodreads_url, more are added as [Shelf name] sections with a url
+DEFAULT_SHELF = "default"
+SHELF_SECTION_PREFIX = "Shelf "
 
 def init_app(db_path: str, url: str, downloads_path: str) -> int:
     """Initialize the application's configuration file."""
@@ -17,6 +48,14 @@ def init_app(db_path: str, url: str, downloads_path: str) -> int:
         return database_code
     return SUCCESS
 
+def init_downloads_dir(downloads_path: Path) -> int:
+    """Initialize the downloads directory."""
+    try:
+        downloads_path.mkdir(exist_ok=True)
+    except OSError:
+        return DOWNLOAD_ERROR
+    return SUCCESS
+
 def _init_config_file() -> int:
     try:
         CONFIG_DIR_PATH.mkdir(exist_ok=True)
@@ -33,7 +72,47 @@ def _create_config(db_path: str, url: str, downloads_path: str) -> int:
     config_parser["General"] = {
         "database_path": db_path,
         "goodreads_url": url,
-        "downloads_path": downloads_path
+        "downloads_path": downloads_path,
+        "database_format": DEFAULT_DATABASE_FORMAT
+    }
+    config_parser["Download"] = {
+        "libgen_url": DEFAULT_LIBGEN_URL,
+        "workers": str(DEFAULT_WORKERS),
+        "max_per_host": str(DEFAULT_MAX_PER_HOST),
+        "search_workers": str(DEFAULT_SEARCH_WORKERS),
+        "retry_backoff_hours": str(DEFAULT_RETRY_BACKOFF_HOURS),
+        "max_retry_backoff_hours": str(DEFAULT_MAX_RETRY_BACKOFF_HOURS)
+    }
+    config_parser["HTTP"] = {
+        "timeout": str(DEFAULT_HTTP_TIMEOUT),
+        "retries": str(DEFAULT_HTTP_RETRIES),
+        "backoff_factor": str(DEFAULT_HTTP_BACKOFF_FACTOR),
+        "connections_per_host": str(DEFAULT_HTTP_CONNECTIONS_PER_HOST),
+        "requests_per_second": str(DEFAULT_HTTP_REQUESTS_PER_SECOND),
+        "burst": str(DEFAULT_HTTP_BURST),
+        "max_retry_after": str(DEFAULT_HTTP_MAX_RETRY_AFTER)
+    }
+    #Per-host requests_per_second overrides, e.g. www.goodreads.com = 1.0
+    config_parser["RateLimits"] = {}
+    config_parser["Goodreads"] = {
+        "per_page": str(DEFAULT_GR_PER_PAGE),
+        "page_workers": str(DEFAULT_GR_PAGE_WORKERS)
+    }
+    config_parser["Cache"] = {
+        "enabled": "yes",
+        "path": str(DEFAULT_CACHE_PATH),
+        "ttl_hours": str(DEFAULT_CACHE_TTL_HOURS),
+        "negative_ttl_hours": str(DEFAULT_CACHE_NEGATIVE_TTL_HOURS),
+        "max_mb": str(DEFAULT_CACHE_MAX_MB)
+    }
+    config_parser["Mirrors"] = {
+        "health_path": str(DEFAULT_MIRROR_HEALTH_PATH),
+        "failure_threshold": str(DEFAULT_MIRROR_FAILURE_THRESHOLD),
+        "cooldown_minutes": str(DEFAULT_MIRROR_COOLDOWN_MINUTES)
+    }
+    config_parser["Watch"] = {
+        "interval_minutes": str(DEFAULT_WATCH_INTERVAL_MINUTES),
+        "jitter": str(DEFAULT_WATCH_JITTER)
     }
     try:
         with CONFIG_FILE_PATH.open("w") as file:
@@ -47,5 +126,38 @@ def get_config_parser() -> configparser.ConfigParser:
     config_parser.read(CONFIG_FILE_PATH)
     return config_parser
 
+def _write_config(config_parser: configparser.ConfigParser) -> int:
+    try:
+        with CONFIG_FILE_PATH.open("w") as file:
+            config_parser.write(file)
+    except OSError:
+        return FILE_ERROR
+    return SUCCESS
+
+def set_database_path(db_path: str) -> int:
+    config_parser = get_config_parser()
+    config_parser["General"]["database_path"] = db_path
+    return _write_config(config_parser)
+
+def get_shelves(config_parser: configparser.ConfigParser) -> Dict[str, str]:
+    """every configured shelf by name, the one in [General] first"""
+    shelves = {}
+    if (config_parser.get("General", "goodreads_url", fallback="")):
+        shelves[DEFAULT_SHELF] = config_parser["General"]["goodreads_url"]
+    for section in config_parser.sections():
+        if (section.startswith(SHELF_SECTION_PREFIX) and config_parser.get(section, "url", fallback="")):
+            shelves[section[len(SHELF_SECTION_PREFIX):]] = config_parser[section]["url"]
+    return shelves
+
+def add_shelf(name: str, url: str) -> int:
+    config_parser = get_config_parser()
+    config_parser[SHELF_SECTION_PREFIX + name] = {"url": url.replace("%", "%%")}
+    return _write_config(config_parser)
+
+def remove_shelf(name: str) -> int:
+    config_parser = get_config_parser()
+    if (not config_parser.remove_section(SHELF_SECTION_PREFIX + name)): return NO_SHELF
+    return _write_config(config_parser)
+
 def get_config_path() -> str:
     return CONFIG_FILE_PATH
\ No newline at end of file
@@ -3,15 +3,45 @@
 import configparser
 from pathlib import Path
 import json
+import gc
+import os
+import sqlite3
+import itertools
+import threading
+from contextlib import closing, contextmanager
 from datetime import datetime
 import typer
-from typing import NamedTuple, Dict, Any
+from typing import NamedTuple, Dict, Any, Iterable, Iterator, List, Optional, Tuple
 import book
+from metrics import METRICS
+from identity import upgrade_keys, KEY_VERSION
+from config import DEFAULT_DATABASE_FORMAT
 
 from __init__ import JSON_ERROR, DB_ERROR, SUCCESS, __app_name__
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import fcntl
+except ImportError:
+    #Without it (Windows) the lock only covers the threads of one process
+    fcntl = None
+
 DEFAULT_DB_PATH = Path(typer.get_app_dir(__app_name__)) / "database.json"
 DEFAULT_DATE_SINCE_UPDATE = "01-01-2000"
+SQLITE_SUFFIXES = (".db", ".sqlite", ".sqlite3")
+BUCKETS = {
+    "undownloaded_books": "undownloaded",
+    "downloaded_books": "downloaded",
+    "failed_books": "failed",
+}
+SORT_FIELDS = ("title", "author", "date_added", "status")
+#compact stores each bucket as rows of values, pretty the original indented dict per book for editing by hand
+DB_FORMATS = ("compact", "pretty")
+COMPACT_VERSION = 1
 
 
 def get_database_path(config_file: Path) -> Path:
@@ -26,38 +56,454 @@ def init_database(db_path: Path, date_since_download: str) -> int:
         "undownloaded_books": {},
         "downloaded_books": {},
         "failed_books": {},
-        "date_since_download": date_since_download
+        "date_since_download": date_since_download,
+        "sync_watermarks": {},
+        "key_version": KEY_VERSION
     }
+    if (db_path.suffix not in SQLITE_SUFFIXES):
+        try:
+            with db_path.open("w") as file:
+                json.dump(db, file)
+            return SUCCESS
+        except OSError:
+            return DB_ERROR
+    if (_remove_sqlite_files(db_path) != SUCCESS): return DB_ERROR
+    return SQLiteDBHandler(db_path).write_db(db).error
+
+def _remove_sqlite_files(db_path: Path) -> int:
     try:
-        with db_path.open("w") as file:
-            json.dump(db, file)
-        return SUCCESS
+        for suffix in ("", "-wal", "-shm"):
+            db_path.with_name(db_path.name + suffix).unlink(missing_ok=True)
     except OSError:
         return DB_ERROR
+    return SUCCESS
+
+def get_db_handler(db_path: Path, db_format: str = DEFAULT_DATABASE_FORMAT) -> "DBHandler":
+    """return the storage engine for db_path, chosen by its file extension"""
+    if (db_path.suffix in SQLITE_SUFFIXES):
+        return SQLiteDBHandler(db_path)
+    return DBHandler(db_path, db_format)
+
+def migrate_database(source_path: Path, destination_path: Path, db_format: str = DEFAULT_DATABASE_FORMAT) -> int:
+    """copy every book and setting from one database to another, e.g. database.json to database.db"""
+    db_response = get_db_handler(source_path).read_db()
+    if (db_response.error != SUCCESS): return db_response.error
+    if (destination_path.suffix in SQLITE_SUFFIXES and _remove_sqlite_files(destination_path) != SUCCESS):
+        return DB_ERROR
+    return get_db_handler(destination_path, db_format).write_db(db_response.db).error
 
 class DBResponse(NamedTuple):
     db: Dict[str, Any]
     error: int
 
+class BookQuery(NamedTuple):
+    """which books list wants; dates are YYYY-MM-DD and both ends are inclusive"""
+    buckets: Tuple[str, ...] = tuple(BUCKETS)
+    title: Optional[str] = None
+    author: Optional[str] = None
+    owner: Optional[str] = None
+    added_after: Optional[str] = None
+    added_before: Optional[str] = None
+    sort: Optional[str] = None
+    descending: bool = False
+    limit: Optional[int] = None
+    offset: int = 0
+
+class BooksResponse(NamedTuple):
+    books: List[Dict[str, Any]]
+    error: int
+
+class CountResponse(NamedTuple):
+    count: int
+    error: int
+
+def _iso_date(date_added: str) -> str:
+    """dates are compared as YYYY-MM-DD so they sort chronologically"""
+    if (date_added is None): return None
+    try:
+        return datetime.strptime(date_added, "%m-%d-%Y").strftime("%Y-%m-%d")
+    except ValueError:
+        return None
+
+def _dumps(data: Dict[str, Any], pretty: bool) -> bytes:
+    if (pretty): return json.dumps(data, indent=4).encode()
+    if (orjson is not None): return orjson.dumps(data)
+    return json.dumps(data, separators=(",", ":")).encode()
+
+def _loads(content: bytes) -> Any:
+    #orjson's JSONDecodeError is a json.JSONDecodeError, callers catch either the same way
+    return orjson.loads(content) if orjson is not None else json.loads(content)
+
+def pack_db(db: Dict[str, Any]) -> Dict[str, Any]:
+    """the compact layout of db: each bucket is columns of keys, record values and shapes, a shape being the index of
+    the record's field names in one shared list, so the names are written once rather than once per book"""
+    shapes = {}
+    packed = {name: value for name, value in db.items() if name not in BUCKETS}
+    for bucket in BUCKETS:
+        records = db[bucket]
+        packed[bucket] = {
+            "keys": list(records),
+            "shapes": [shapes.setdefault(tuple(record), len(shapes)) for record in records.values()],
+            "values": [list(record.values()) for record in records.values()],
+        }
+    packed["storage"] = {"version": COMPACT_VERSION, "shapes": list(shapes)}
+    return packed
+
+def unpack_db(data: Dict[str, Any]) -> Dict[str, Any]:
+    """the database in a file of either layout"""
+    storage = data.pop("storage", None)
+    if (storage is None): return data
+    shapes = storage["shapes"]
+    for bucket in BUCKETS:
+        columns = data[bucket]
+        #Chained maps build the records without running a bytecode loop per book
+        records = map(dict, map(zip, map(shapes.__getitem__, columns["shapes"]), columns["values"]))
+        data[bucket] = dict(zip(columns["keys"], records))
+    return data
+
+def _book_row(key: str, bucket: str, record: Dict[str, Any]) -> Dict[str, Any]:
+    return {"key": key, "status": BUCKETS[bucket], **record}
+
 class DBHandler:
-    def __init__(self, db_path: Path) -> None:
+    def __init__(self, db_path: Path, db_format: str = DEFAULT_DATABASE_FORMAT) -> None:
         self.db_path = db_path
+        self.db_format = db_format
+        self.journal_path = db_path.with_name(db_path.name + ".journal")
+        self.lock_path = db_path.with_name(db_path.name + ".lock")
+        self._lock = threading.RLock()
+        self._lock_depth = 0
+        self._lock_file = None
+
+    @contextmanager
+    def locked(self) -> Iterator[None]:
+        """hold the database for a read-modify-write cycle, against other threads and other goldfinch processes;
+        re-entrant, so the reads and writes inside it don't lock again"""
+        with self._lock:
+            if (self._lock_depth == 0 and fcntl is not None):
+                try:
+                    self._lock_file = self.lock_path.open("a")
+                    fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+                except OSError:
+                    #A directory goldfinch can't create the lock file in is one it can't write the database to either
+                    self._lock_file = None
+            self._lock_depth += 1
+            try:
+                yield
+            finally:
+                self._lock_depth -= 1
+                if (self._lock_depth == 0 and self._lock_file is not None):
+                    #Closing the file releases the flock
+                    self._lock_file.close()
+                    self._lock_file = None
     
+    @METRICS.timed("read_db")
     def read_db(self) -> DBResponse:
+        #Locked because replaying the journal writes the database
+        with self.locked():
+            try:
+                with self.db_path.open("rb") as db:
+                    content = db.read()
+            except OSError:  # Catch file IO problems
+                return DBResponse([], DB_ERROR)
+            #Loading allocates a container per book, the collections that would trigger only rescan them
+            gc_was_enabled = gc.isenabled()
+            gc.disable()
+            try:
+                db_response = DBResponse(unpack_db(_loads(content)), SUCCESS)
+            except (json.JSONDecodeError, KeyError, TypeError, IndexError):  # Catch wrong JSON format
+                return DBResponse([], JSON_ERROR)
+            finally:
+                if (gc_was_enabled): gc.enable()
+            db_response = self._replay_journal(db_response.db)
+        if (db_response.error != SUCCESS): return db_response
+        return DBResponse(upgrade_keys(db_response.db), SUCCESS)
+
+    @METRICS.timed("write_db")
+    def write_db(self, db : Dict[str, Any]) -> DBResponse:
+        temp_path = self.db_path.with_name(self.db_path.name + ".tmp")
+        content = _dumps(db, True) if self.db_format == "pretty" else _dumps(pack_db(db), False)
+        with self.locked():
+            try:
+                with temp_path.open("wb") as db_file:
+                    db_file.write(content)
+                    db_file.flush()
+                    os.fsync(db_file.fileno())
+                os.replace(temp_path, self.db_path)
+                #Everything in the journal is part of db now
+                self.journal_path.unlink(missing_ok=True)
+                return DBResponse(db, SUCCESS)
+            except OSError:  # Catch file IO problems
+                return DBResponse(db, DB_ERROR)
+
+    @METRICS.timed("select_books")
+    def select_books(self, query: BookQuery) -> BooksResponse:
+        db_response = self.read_db()
+        if (db_response.error != SUCCESS): return BooksResponse([], db_response.error)
+        matches = self._matching(db_response.db, query)
+        if (query.sort is not None):
+            matches = sorted(matches, key=DBHandler._sort_key(query.sort), reverse=query.descending)
+        elif (query.descending):
+            matches = reversed(list(matches))
+        stop = None if query.limit is None else query.offset + query.limit
+        return BooksResponse([_book_row(*match) for match in itertools.islice(matches, query.offset, stop)], SUCCESS)
+
+    @METRICS.timed("count_books")
+    def count_books(self, query: BookQuery) -> CountResponse:
+        db_response = self.read_db()
+        if (db_response.error != SUCCESS): return CountResponse(0, db_response.error)
+        return CountResponse(sum(1 for _ in self._matching(db_response.db, query)), SUCCESS)
+
+    def _matching(self, db: Dict[str, Any], query: BookQuery) -> Iterator[Tuple[str, str, Dict[str, Any]]]:
+        title = query.title.lower() if query.title else None
+        author = query.author.lower() if query.author else None
+        for bucket in BUCKETS:
+            if (bucket not in query.buckets): continue
+            for key, record in db[bucket].items():
+                if (title is not None and title not in (record.get("title") or "").lower()): continue
+                if (author is not None and author not in (record.get("author") or "").lower()): continue
+                if (query.owner is not None and query.owner not in (record.get("owners") or [])): continue
+                if (query.added_after is not None or query.added_before is not None):
+                    date_added = _iso_date(record.get("date_added"))
+                    if (date_added is None): continue
+                    if (query.added_after is not None and date_added < query.added_after): continue
+                    if (query.added_before is not None and date_added > query.added_before): continue
+                yield key, bucket, record
+
+    @staticmethod
+    def _sort_key(field: str):
+        order = {bucket: position for position, bucket in enumerate(BUCKETS)}
+        if (field == "status"): return lambda match: order[match[1]]
+        if (field == "date_added"): return lambda match: _iso_date(match[2].get("date_added")) or ""
+        return lambda match: (match[2].get(field) or "").lower()
+
+    def checkpoint(self, key: str, destination: str, record: Dict[str, Any]) -> int:
+        """durably record that a book moved out of undownloaded_books into destination"""
+        entry = json.dumps({"key": key, "destination": destination, "record": record})
+        #Locked so the entry can't land between another process replaying the journal and removing it
+        with self.locked():
+            try:
+                with self.journal_path.open("a") as journal:
+                    journal.write(entry + "\n")
+                    journal.flush()
+                    os.fsync(journal.fileno())
+            except OSError:
+                return DB_ERROR
+        return SUCCESS
+
+    def _replay_journal(self, db: Dict[str, Any]) -> DBResponse:
+        """apply the checkpoints of an interrupted run to db and compact them into the database file"""
         try:
-            with self.db_path.open("r") as db:
-                try:
-                    return DBResponse(json.load(db), SUCCESS)
-                except json.JSONDecodeError:  # Catch wrong JSON format
-                    return DBResponse([], JSON_ERROR)
-        except OSError:  # Catch file IO problems
+            with self.journal_path.open("r") as journal:
+                lines = journal.readlines()
+        except FileNotFoundError:
+            return DBResponse(db, SUCCESS)
+        except OSError:
+            return DBResponse(db, DB_ERROR)
+        for line in lines:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                #A torn last line from a crash mid-append
+                continue
+            apply_checkpoint(db, entry["key"], entry["destination"], entry["record"])
+        return self.write_db(db)
+
+def apply_checkpoint(db: Dict[str, Any], key: str, destination: str, record: Dict[str, Any]) -> None:
+    #Owners a sync added while the book was downloading are kept
+    owners = [owner for bucket in BUCKETS for owner in db[bucket].get(key, {}).get("owners", [])]
+    if (owners):
+        record = dict(record, owners=list(dict.fromkeys(record.get("owners", []) + owners)))
+    for bucket in BUCKETS:
+        if (bucket != destination): db[bucket].pop(key, None)
+    db[destination][key] = record
+
+class SQLiteDBHandler(DBHandler):
+    """stores the database in SQLite, one row per book, behind the DBHandler interface"""
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS books (
+            key TEXT PRIMARY KEY,
+            status TEXT NOT NULL,
+            title TEXT,
+            author TEXT,
+            date_added TEXT,
+            record TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS books_status ON books (status);
+        CREATE INDEX IF NOT EXISTS books_date_added ON books (date_added);
+        CREATE TABLE IF NOT EXISTS meta (
+            name TEXT PRIMARY KEY,
+            value TEXT
+        );
+    """
+
+    def __init__(self, db_path: Path) -> None:
+        super().__init__(db_path)
+        #The rows each thread last read or wrote, so writing back a db read here only touches what changed
+        self._loaded = threading.local()
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.db_path)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.executescript(SQLiteDBHandler.SCHEMA)
+        return connection
+
+    def _row(self, key: str, bucket: str, record: Dict[str, Any]) -> tuple:
+        return (
+            key,
+            BUCKETS[bucket],
+            record.get("title"),
+            record.get("author"),
+            _iso_date(record.get("date_added")),
+            json.dumps(record),
+        )
+
+    def _remember(self, db: Dict[str, Any], rows: Dict[str, Tuple[str, str]], meta: Dict[str, str]) -> None:
+        #The stored JSON rather than records, it is only parsed again if db is written back
+        self._loaded.db = db
+        self._loaded.rows = rows
+        self._loaded.meta = meta
+
+    @staticmethod
+    def _parse_records(texts: Iterable[str]) -> List[Dict[str, Any]]:
+        #One parse of every record rather than a call per row
+        gc_was_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            return _loads("[" + ",".join(texts) + "]")
+        finally:
+            if (gc_was_enabled): gc.enable()
+
+    @METRICS.timed("read_db")
+    def read_db(self) -> DBResponse:
+        if (not self.db_path.exists()):
             return DBResponse([], DB_ERROR)
+        buckets = {status: bucket for bucket, status in BUCKETS.items()}
+        db = {bucket: {} for bucket in BUCKETS}
+        try:
+            with closing(self._connect()) as connection:
+                rows = connection.execute("SELECT key, status, record FROM books ORDER BY rowid").fetchall()
+                meta = dict(connection.execute("SELECT name, value FROM meta"))
+            records = SQLiteDBHandler._parse_records(row[2] for row in rows)
+            for name, value in meta.items():
+                db[name] = json.loads(value)
+        except sqlite3.Error:
+            return DBResponse([], DB_ERROR)
+        except json.JSONDecodeError:
+            return DBResponse([], JSON_ERROR)
+        for (key, status, _), record in zip(rows, records):
+            db[buckets[status]][key] = record
+        db = upgrade_keys(db)
+        self._remember(db, {key: (status, text) for key, status, text in rows}, meta)
+        return DBResponse(db, SUCCESS)
 
+    @METRICS.timed("write_db")
     def write_db(self, db : Dict[str, Any]) -> DBResponse:
+        #A key in several buckets keeps the last one written, downloaded wins over failed
+        order = ("failed_books", "undownloaded_books", "downloaded_books")
+        rows = {key: (bucket, record) for bucket in order for key, record in db[bucket].items()}
+        meta = {name: json.dumps(value) for name, value in db.items() if name not in BUCKETS}
+        #A db read on this thread is compared with what was read and only the rows that changed are written,
+        #any other (a migration, a new database) replaces every row
+        loaded = getattr(self._loaded, "db", None) is db
+        loaded_rows = self._loaded.rows if loaded else {}
+        loaded_meta = self._loaded.meta if loaded else {}
+        loaded_records = dict(zip(loaded_rows, SQLiteDBHandler._parse_records(text for _, text in loaded_rows.values())))
+        changed = {
+            key: self._row(key, bucket, record) for key, (bucket, record) in rows.items()
+            if key not in loaded_rows or loaded_rows[key][0] != BUCKETS[bucket] or loaded_records[key] != record
+        }
+        removed = [key for key in loaded_rows if key not in rows]
+        #Books that stay in their bucket are updated in place and keep their order, moved ones go to the end like in the JSON file
+        updated = [row[2:] + (key,) for key, row in changed.items() if key in loaded_rows and loaded_rows[key][0] == row[1]]
+        inserted = [row for key, row in changed.items() if key not in loaded_rows or loaded_rows[key][0] != row[1]]
         try:
-            with self.db_path.open("w") as db_file:
-                json.dump(db, db_file, indent=4)
-            return DBResponse(db, SUCCESS)
-        except OSError:  # Catch file IO problems
+            with closing(self._connect()) as connection, connection:
+                #One transaction, a crash leaves the previous state intact
+                if (not loaded):
+                    connection.execute("DELETE FROM books")
+                    connection.execute("DELETE FROM meta")
+                connection.executemany("DELETE FROM books WHERE key = ?", [(key,) for key in removed])
+                connection.executemany("DELETE FROM meta WHERE name = ?", [(name,) for name in loaded_meta if name not in meta])
+                connection.executemany("UPDATE books SET title = ?, author = ?, date_added = ?, record = ? WHERE key = ?", updated)
+                connection.executemany("INSERT OR REPLACE INTO books VALUES (?, ?, ?, ?, ?, ?)", inserted)
+                connection.executemany("INSERT OR REPLACE INTO meta VALUES (?, ?)",
+                                       [(name, value) for name, value in meta.items() if loaded_meta.get(name) != value])
+        except sqlite3.Error:
             return DBResponse(db, DB_ERROR)
-    
\ No newline at end of file
+        for key in removed:
+            del loaded_rows[key]
+        for key, row in changed.items():
+            loaded_rows[key] = (row[1], row[5])
+        self._remember(db, loaded_rows, meta)
+        return DBResponse(db, SUCCESS)
+
+    @METRICS.timed("select_books")
+    def select_books(self, query: BookQuery) -> BooksResponse:
+        """filter, sort and page in SQL so only the wanted rows are decoded"""
+        if (not self.db_path.exists()):
+            return BooksResponse([], DB_ERROR)
+        where, params = self._where(query)
+        statuses = {status: bucket for bucket, status in BUCKETS.items()}
+        order = self._order(query)
+        try:
+            with closing(self._connect()) as connection:
+                rows = connection.execute(
+                    f"SELECT key, status, record FROM books {where} ORDER BY {order} LIMIT ? OFFSET ?",
+                    params + [query.limit if query.limit is not None else -1, query.offset],
+                )
+                return BooksResponse([_book_row(key, statuses[status], json.loads(record)) for key, status, record in rows], SUCCESS)
+        except sqlite3.Error:
+            return BooksResponse([], DB_ERROR)
+        except json.JSONDecodeError:
+            return BooksResponse([], JSON_ERROR)
+
+    @METRICS.timed("count_books")
+    def count_books(self, query: BookQuery) -> CountResponse:
+        if (not self.db_path.exists()):
+            return CountResponse(0, DB_ERROR)
+        where, params = self._where(query)
+        try:
+            with closing(self._connect()) as connection:
+                return CountResponse(connection.execute(f"SELECT COUNT(*) FROM books {where}", params).fetchone()[0], SUCCESS)
+        except sqlite3.Error:
+            return CountResponse(0, DB_ERROR)
+
+    @staticmethod
+    def _where(query: BookQuery) -> Tuple[str, list]:
+        clauses = [f"status IN ({", ".join("?" for _ in query.buckets)})"]
+        params = [BUCKETS[bucket] for bucket in query.buckets]
+        for column, value in (("title", query.title), ("author", query.author)):
+            if (value):
+                clauses.append(f"{column} LIKE ? ESCAPE '\\'")
+                params.append("%" + value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%")
+        if (query.owner is not None):
+            clauses.append("EXISTS (SELECT 1 FROM json_each(record, '$.owners') WHERE value = ?)")
+            params.append(query.owner)
+        if (query.added_after is not None):
+            clauses.append("date_added >= ?")
+            params.append(query.added_after)
+        if (query.added_before is not None):
+            clauses.append("date_added <= ?")
+            params.append(query.added_before)
+        return "WHERE " + " AND ".join(clauses), params
+
+    @staticmethod
+    def _order(query: BookQuery) -> str:
+        direction = "DESC" if query.descending else "ASC"
+        #Without a sort, match the JSON backend: bucket by bucket, each in insertion order
+        status_order = "CASE status " + " ".join(f"WHEN '{status}' THEN {position}" for position, status in enumerate(BUCKETS.values())) + " END"
+        if (query.sort is None): return f"{status_order} {direction}, rowid {direction}"
+        if (query.sort == "status"): return f"{status_order} {direction}, rowid"
+        if (query.sort == "date_added"): return f"COALESCE(date_added, '') {direction}, rowid"
+        return f"{query.sort} COLLATE NOCASE {direction}, rowid"
+
+    def checkpoint(self, key: str, destination: str, record: Dict[str, Any]) -> int:
+        """commit a single book's move, SQLite's own journal makes it durable"""
+        #Locked so it can't land between another process reading the books and writing them back
+        with self.locked():
+            try:
+                with closing(self._connect()) as connection, connection:
+                    connection.execute("INSERT OR REPLACE INTO books VALUES (?, ?, ?, ?, ?, ?)", self._row(key, destination, record))
+            except sqlite3.Error:
+                return DB_ERROR
+        return SUCCESS
@@ -2,52 +2,202 @@
 
 from pathlib import Path
 import typer
-from typing import NamedTuple
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional, Tuple
 import requests
-from bs4 import BeautifulSoup
+import hashlib
+import re
 from datetime import datetime
+from time import perf_counter
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+import os
+import threading
 import urllib.parse
 
+from http_client import HTTPClient
+from cache import SearchCache
+from parsing import make_soup, FICTION_RESULTS, NONFICTION_RESULTS, MIRROR_DOWNLOAD
+from ranking import rank
+from metrics import METRICS
+from mirrors import MirrorHealth
+from identity import book_id
+from library import StoredFile, detect_format, link_md5, HEADER_SIZE
+from config import DEFAULT_MAX_PER_HOST, DEFAULT_SEARCH_WORKERS, DEFAULT_LIBGEN_URL
 from __init__ import __app_name__, SUCCESS, DOWNLOAD_ERROR, NO_RESULTS, CANT_REACH_LIBGEN
 
-DEFAULT_DOWNLOADS_DIR = Path.home() / "goldfinch_book_downloads"
-
-def init_downloads_dir(downloads_path: Path) -> int:
-    """Initialize the downloads directory."""
-    try:
-        downloads_path.mkdir(exist_ok=True)
-    except OSError:
-        return DOWNLOAD_ERROR
-    return SUCCESS
+CHUNK_SIZE = 64 * 1024
+UNSAFE_FILENAME_PATTERN = re.compile(r'[\\/:*?"<>|]')
 
 class DownloadResponse(NamedTuple):
     title: str
     link: str
     date_downloaded: str
     error: int
+    file: StoredFile = None
 
 class Downloader:
-    def __init__(self, downloads_path: Path) -> None:
+    def __init__(self, downloads_path: Path, max_per_host: int = DEFAULT_MAX_PER_HOST, http_client: HTTPClient = None,
+                 search_cache: SearchCache = None, search_workers: int = DEFAULT_SEARCH_WORKERS,
+                 libgen_url: str = DEFAULT_LIBGEN_URL, mirror_health: MirrorHealth = None) -> None:
         self.downloads_path = downloads_path
+        self.mirror_health = mirror_health
+        self.libgen_url = libgen_url.rstrip("/")
+        self.http = http_client or HTTPClient()
+        self.search_cache = search_cache
+        #Shared by every book so concurrent downloads can't multiply the number of searches in flight
+        self._search_pool = ThreadPoolExecutor(max_workers=search_workers)
+        self.max_per_host = max_per_host
+        self._host_slots = {}
+        self._host_slots_lock = threading.Lock()
+        #Files already in the library by md5, so the same file is never fetched or stored twice
+        self.known_files: Dict[str, StoredFile] = {}
+        self._library_lock = threading.Lock()
+
+    @contextmanager
+    def _host_slot(self, url: str):
+        """limit the number of concurrent requests made to the host of url"""
+        host = urllib.parse.urlparse(url).netloc
+        with self._host_slots_lock:
+            if host not in self._host_slots:
+                self._host_slots[host] = threading.BoundedSemaphore(self.max_per_host)
+            slot = self._host_slots[host]
+        with slot:
+            yield
+
+    def _get(self, url: str) -> requests.Response:
+        with self._host_slot(url):
+            return self.http.get(url)
     
-    def try_url_download(self, urls, download_path: Path) -> str:
+    def index_files(self, records: Iterable[Dict[str, Any]]) -> None:
+        """remember the files of already downloaded books"""
+        with self._library_lock:
+            for record in records:
+                if (record.get("md5") and record.get("path")):
+                    self.known_files[record["md5"]] = StoredFile(Path(record["path"]), record["md5"], record.get("size"), record.get("format"))
+
+    def _known_file(self, md5: Optional[str]) -> Optional[StoredFile]:
+        stored = self.known_files.get(md5) if md5 is not None else None
+        return stored if stored is not None and stored.path.exists() else None
+
+    def _store(self, download_path: Path, title: str, md5: str) -> StoredFile:
+        """move a finished download into the library named after its title and real format, or drop it if the library has the file already"""
+        with download_path.open("rb") as file:
+            file_format = detect_format(file.read(HEADER_SIZE))
+        size = download_path.stat().st_size
+        with self._library_lock:
+            known = self._known_file(md5)
+            if (known is not None):
+                download_path.unlink()
+                METRICS.count("duplicate_files")
+                return known
+            stem = UNSAFE_FILENAME_PATTERN.sub("_", title.replace(" ", "_"))
+            extension = file_format if file_format != "unknown" else "bin"
+            path = self.downloads_path / f"{stem}.{extension}"
+            if (path.exists()):
+                #Another book with the same title
+                path = self.downloads_path / f"{stem}_{md5[:8]}.{extension}"
+            os.replace(download_path, path)
+            stored = StoredFile(path, md5, size, file_format)
+            self.known_files[md5] = stored
+            return stored
+
+    @METRICS.timed("try_url_download")
+    def try_url_download(self, urls, download_path: Path) -> Tuple[str, Optional[str], Optional[StoredFile]]:
+        """download from the first mirror that works, returning its url, the md5 of the file
+        and the library file instead if the library already has it"""
         for url in urls:
+            #libgen links carry the md5 of their file, one we already have needn't be fetched again.
+            #Checked in the order the links are tried, so a worse candidate we happen to have can't win
+            known = self._known_file(link_md5(url))
+            if (known is not None):
+                return url, known.md5, known
             typer.secho(f"Trying url: {url}", fg=typer.colors.BRIGHT_CYAN)
+            host = urllib.parse.urlparse(url).netloc
+            started = perf_counter()
             try:
-                request = requests.get(url)
-                soup = BeautifulSoup(request.content, "html.parser")
+                request = self._get(url)
+                soup = make_soup(request.content, MIRROR_DOWNLOAD)
                 download_url = soup.find_all("div", id = "download")[0].find("a")["href"]
-                request = requests.get(download_url)
-            except requests.RequestException:
+            except (requests.RequestException, IndexError, TypeError, KeyError):
+                #Unreachable, or a mirror page without a download link
+                self._record_mirror(host, perf_counter() - started, False)
                 continue
-            if (request.status_code != 200): continue
-            with open(download_path, "wb") as file:
-                file.write(request.content)
-            return f"{url}"
-        return ""
+            latency = perf_counter() - started
+            started = perf_counter()
+            md5 = self.stream_download(url, download_url, download_path)
+            if (md5 is None):
+                self._record_mirror(host, latency, False, 0, perf_counter() - started)
+                continue
+            self._record_mirror(host, latency, True, download_path.stat().st_size, perf_counter() - started)
+            return f"{url}", md5, None
+        return "", None, None
+
+    def _record_mirror(self, host: str, latency: float, ok: bool, size: int = 0, transfer_seconds: float = 0.0) -> None:
+        METRICS.record_mirror(host, latency, ok, size, transfer_seconds)
+        if (self.mirror_health is not None):
+            self.mirror_health.record(host, latency, ok, size, transfer_seconds)
+
+    def order_mirrors(self, ranked: List[Dict[str, Any]]) -> List[str]:
+        """the mirror links to try, best candidate first and each candidate's healthiest mirror first"""
+        links = []
+        for result in ranked:
+            mirrors = result["mirrors"] if self.mirror_health is None else self.mirror_health.order(result["mirrors"])
+            links.extend(link for link in mirrors if link not in links)
+        if (not links and self.mirror_health is not None):
+            #Every mirror's circuit is open. Trying them anyway beats failing the book, and backing it off, over our own breaker
+            METRICS.count("all_mirrors_open")
+            links = list(dict.fromkeys(link for result in ranked for link in result["mirrors"]))
+        return links
+
+    def stream_download(self, source: str, download_url: str, download_path: Path) -> Optional[str]:
+        """stream download_url to download_path in chunks, resuming an interrupted download of the same source,
+        returning the md5 of the file or None if it failed"""
+        part_path = download_path.with_name(download_path.name + ".part")
+        source_path = download_path.with_name(download_path.name + ".part.src")
+        resume_from = 0
+        if (part_path.exists() and source_path.exists() and source_path.read_text() == source):
+            resume_from = part_path.stat().st_size
+        headers = {"Range": f"bytes={resume_from}-"} if resume_from else {}
+
+        try:
+            with self._host_slot(download_url), self.http.get(download_url, headers=headers, stream=True) as request:
+                if (request.status_code == 416):
+                    #Range not satisfiable, the partial file can't be resumed
+                    part_path.unlink(missing_ok=True)
+                    return None
+                if (request.status_code not in (200, 206)): return None
+                if (request.status_code == 200): resume_from = 0
+                md5 = self._part_md5(part_path) if resume_from else hashlib.md5()
+
+                expected_size = None
+                if ("Content-Length" in request.headers and "Content-Encoding" not in request.headers):
+                    expected_size = resume_from + int(request.headers["Content-Length"])
+
+                source_path.write_text(source)
+                with open(part_path, "ab" if resume_from else "wb") as file:
+                    for chunk in request.iter_content(chunk_size=CHUNK_SIZE):
+                        file.write(chunk)
+                        md5.update(chunk)
+        except (requests.RequestException, OSError):
+            #Keep the partial file so the next attempt can resume it
+            return None
+
+        if (expected_size is not None and part_path.stat().st_size != expected_size):
+            return None
+        os.replace(part_path, download_path)
+        source_path.unlink(missing_ok=True)
+        return md5.hexdigest()
+
+    def _part_md5(self, part_path: Path) -> "hashlib._Hash":
+        """hash what an interrupted download already wrote, the rest is hashed as it arrives"""
+        md5 = hashlib.md5()
+        with part_path.open("rb") as file:
+            while (chunk := file.read(CHUNK_SIZE)):
+                md5.update(chunk)
+        return md5
 
     class SearchResponse(NamedTuple):
-        links: str
+        results: List[Dict[str, Any]]
         error: int
     
     (AUTHOR, BOTH, TITLE) = range(3)
@@ -59,7 +209,22 @@ class Downloader:
     }
 
     def search_libgen(self, title: str, author: str, criteria: int, locale: int) -> SearchResponse:
-        """search for a book by author on libgen.is"""
+        """search for a book by author on libgen.is, answering from the search cache when possible"""
+        if (self.search_cache is None):
+            return self._search_libgen(title, author, criteria, locale)
+        cache_key = SearchCache.make_key(title, author, criteria, locale)
+        cached = self.search_cache.get(cache_key)
+        METRICS.count("search_cache_hits" if cached is not None else "search_cache_misses")
+        if (cached is not None):
+            return Downloader.SearchResponse(cached.results, cached.error)
+        search_response = self._search_libgen(title, author, criteria, locale)
+        if (search_response.error in (SUCCESS, NO_RESULTS)):
+            self.search_cache.put(cache_key, search_response.results, search_response.error)
+        return search_response
+
+    @METRICS.timed("search_libgen")
+    def _search_libgen(self, title: str, author: str, criteria: int, locale: int) -> SearchResponse:
+        """run one search on libgen.is"""
 
         ## URL encode the search terms
         url_author = urllib.parse.quote(author)
@@ -76,56 +241,84 @@ class Downloader:
         url = ""
         match locale:
             case Downloader.FICTION:
-                url = f"https://libgen.is/fiction/?q={search_term}&criteria={Downloader.CRITERIA[criteria]}&language=English&format=epub"
+                url = f"{self.libgen_url}/fiction/?q={search_term}&criteria={Downloader.CRITERIA[criteria]}&language=English&format=epub"
             case Downloader.NONFICTION:
-                url = f"https://libgen.is/search.php?req={search_term}&open=0&res=100&view=simple&phrase=1&column=def"
+                url = f"{self.libgen_url}/search.php?req={search_term}&open=0&res=100&view=simple&phrase=1&column=def"
 
         try:
-            request = requests.get(url)
+            request = self._get(url)
         except requests.RequestException:
-            return Downloader.SearchResponse("", CANT_REACH_LIBGEN)
-        
-        soup = BeautifulSoup(request.content, "html.parser")
-        table = soup.find("table", class_ = "catalog" if locale == Downloader.FICTION else "c")
+            return Downloader.SearchResponse([], CANT_REACH_LIBGEN)
+        if (request.status_code != 200):
+            #An error page has no results table, it mustn't be cached as a search that found nothing
+            return Downloader.SearchResponse([], CANT_REACH_LIBGEN)
+        return self.parse_search(request.content, locale)
+
+    @METRICS.timed("parse_search")
+    def parse_search(self, content: bytes, locale: int) -> SearchResponse:
+        """extract the title, author, format, size and mirror links of every result on a search page"""
+        if (locale == Downloader.FICTION):
+            soup = make_soup(content, FICTION_RESULTS)
+            table = soup.find("table", class_ = "catalog")
+        else:
+            soup = make_soup(content, NONFICTION_RESULTS)
+            table = soup.find("table", class_ = "c")
         if (table is None): 
-            return Downloader.SearchResponse("", NO_RESULTS)
+            return Downloader.SearchResponse([], NO_RESULTS)
         items = table.find_all("tr")[1:]
         if (len(items) == 0): 
-            return Downloader.SearchResponse("", NO_RESULTS)
-        return_links = []
+            return Downloader.SearchResponse([], NO_RESULTS)
+        results = []
         for item in items:
-            item_title = item.find_all("td")[2].find("a").text
-            if (item_title not in title and title not in item_title): continue
-            mirrors = item.find_all("ul", class_ = "record_mirrors_compact") if locale == Downloader.FICTION else item.find_all("td")[9:10]
-            links = mirrors[0].find_all("li") if locale == Downloader.FICTION else mirrors
-            return_links.append(links[0].find("a")["href"])
-        return Downloader.SearchResponse(return_links, SUCCESS)
-
+            cells = item.find_all("td")
+            if (locale == Downloader.FICTION):
+                extension, _, size = cells[4].text.partition("/")
+                mirrors = item.find("ul", class_ = "record_mirrors_compact").find_all("a")
+                author = cells[0].text
+            else:
+                extension, size = cells[8].text, cells[7].text
+                mirrors = [cell.find("a") for cell in cells[9:11]]
+                author = cells[1].text
+            results.append({
+                "title": cells[2].find("a").text,
+                "author": author.strip(),
+                "extension": extension.strip(),
+                "size": size.strip(),
+                "mirrors": [mirror["href"] for mirror in mirrors if mirror is not None and mirror.has_attr("href")],
+            })
+        return Downloader.SearchResponse(results, SUCCESS)
 
+    @METRICS.timed("download_book")
     def download(self, title: str, author: str) -> DownloadResponse:
         """main function for downloading books from libgen.is"""
-        download_file_path = self.downloads_path / f"{title.replace(' ', '_')}.epub"
-        
-        typer.secho(f"Searching for {title} by {author} in fiction", fg=typer.colors.BRIGHT_CYAN)
-        for i in range(3):
-            search_response_title = self.search_libgen(title, author, i, Downloader.FICTION)
-            if (search_response_title.error == CANT_REACH_LIBGEN): return DownloadResponse(title, "", "", CANT_REACH_LIBGEN)
-            if (search_response_title.error == SUCCESS):
-                download_try = self.try_url_download(search_response_title.links, download_file_path)
-                if (download_try != ""):
-                    time = datetime.now()
-                    time_str = time.strftime(r"%m-%d-%Y %H:%M:%S")
-                    return DownloadResponse(title, download_try, time_str, SUCCESS)
+        #Named after the book rather than the title, so two books with one title can't share a partial file
+        download_file_path = self.downloads_path / f".{hashlib.md5(book_id(title, author).encode()).hexdigest()}.download"
         
-        typer.secho(f"Searching for {title} by {author} in nonfiction", fg=typer.colors.BRIGHT_CYAN)
-        for i in range(3):
-            search_response_title = self.search_libgen(title, author, i, Downloader.NONFICTION)
-            if (search_response_title.error == CANT_REACH_LIBGEN): return DownloadResponse(title, "", "", CANT_REACH_LIBGEN)
-            if (search_response_title.error == SUCCESS):
-                download_try = self.try_url_download(search_response_title.links, download_file_path)
-                if (download_try != ""):
-                    time = datetime.now()
-                    time_str = time.strftime(r"%m-%d-%Y %H:%M:%S")
-                    return DownloadResponse(title, download_try, time_str, SUCCESS)
-
-        return DownloadResponse(title, "", "", DOWNLOAD_ERROR)
\ No newline at end of file
+        #Every fiction and nonfiction variant is searched at once and the results ranked together
+        typer.secho(f"Searching for {title} by {author}", fg=typer.colors.BRIGHT_CYAN)
+        searches = [
+            self._search_pool.submit(self.search_libgen, title, author, criteria, locale)
+            for locale in (Downloader.FICTION, Downloader.NONFICTION)
+            for criteria in (Downloader.AUTHOR, Downloader.BOTH, Downloader.TITLE)
+        ]
+        search_responses = [search.result() for search in searches]
+        results = [result for response in search_responses if response.error == SUCCESS for result in response.results]
+        links = self.order_mirrors(rank(results, title, author))
+        if (len(links) == 0):
+            if (any(response.error == CANT_REACH_LIBGEN for response in search_responses)):
+                return DownloadResponse(title, "", "", CANT_REACH_LIBGEN)
+            return DownloadResponse(title, "", "", DOWNLOAD_ERROR)
+
+        download_try, md5, known = self.try_url_download(links, download_file_path)
+        if (download_try == ""):
+            return DownloadResponse(title, "", "", DOWNLOAD_ERROR)
+        if (known is not None):
+            METRICS.count("downloads_skipped_known_file")
+            return DownloadResponse(title, download_try, datetime.now().strftime(r"%m-%d-%Y %H:%M:%S"), SUCCESS, known)
+        try:
+            stored = self._store(download_file_path, title, md5)
+        except OSError:
+            return DownloadResponse(title, "", "", DOWNLOAD_ERROR)
+        time = datetime.now()
+        time_str = time.strftime(r"%m-%d-%Y %H:%M:%S")
+        return DownloadResponse(title, download_try, time_str, SUCCESS, stored)
@@ -1,146 +1,554 @@
 from pathlib import Path
 import typer
+import csv
+import queue
+import random
+import threading
+import time
 from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+from typing import Dict, Any, Iterable, List, NamedTuple, Tuple, TYPE_CHECKING
 
-from goodreads import GRHandler
-from database import DBHandler, DBResponse
-from downloader import Downloader, DownloadResponse
+from database import get_db_handler, apply_checkpoint, DBResponse, BookQuery
 from book import Book
-from __init__ import SUCCESS, ERRORS, NOT_IN_DB
+from importer import read_books, ImportResponse, RemoveResponse
+from identity import BookIndex, book_id
+from listing import format_books
+from library import verify_file
+from scheduler import plan, record_failure, new_claim, is_claimed
+from http_client import HTTPClient
+from cache import SearchCache
+from mirrors import MirrorHealth
+from metrics import METRICS
+from config import DEFAULT_WORKERS, DEFAULT_MAX_PER_HOST, DEFAULT_SEARCH_WORKERS, DEFAULT_GR_PER_PAGE, DEFAULT_GR_PAGE_WORKERS, DEFAULT_LIBGEN_URL
+from config import DEFAULT_WATCH_INTERVAL_MINUTES, DEFAULT_WATCH_JITTER, DEFAULT_SHELF
+from config import DEFAULT_RETRY_BACKOFF_HOURS, DEFAULT_MAX_RETRY_BACKOFF_HOURS, DEFAULT_DATABASE_FORMAT
+from __init__ import SUCCESS, ERRORS, NOT_IN_DB, FILE_ERROR, GR_ERROR, NO_SHELF
+
+if TYPE_CHECKING:
+    from goodreads import GRHandler
+    from downloader import Downloader
+
+#Books read from the shelves but not merged yet, bounding sync_shelf's memory however long the shelves are
+SYNC_QUEUE_SIZE = 1000
+#Books a download run claims at a time for each of its workers
+CLAIM_BATCH_PER_WORKER = 4
+#Fields about a single download attempt or the file it produced, left behind when a book changes bucket
+ATTEMPT_FIELDS = ("claim", "attempts", "last_attempt", "failure_reason", "requeued")
+FILE_FIELDS = ("date_downloaded", "link", "path", "md5", "size", "format")
+
+class SyncResponse(NamedTuple):
+    added: List[str]
+    error: int
+
+class ClaimResponse(NamedTuple):
+    books: Dict[str, Dict[str, Any]]
+    error: int
+
+class VerifyResponse(NamedTuple):
+    checked: int
+    problems: Dict[str, str]
+    error: int
 
 class Goldfinch:
-    def __init__(self, db_path: Path, gr_url: str, downloads_path: Path) -> None:
-        self.db_handler = DBHandler(db_path)
-        self.gr_handler = GRHandler(gr_url)
-        self.downloader = Downloader(downloads_path)
+    def __init__(self, db_path: Path, gr_url: str, downloads_path: Path,
+                 workers: int = DEFAULT_WORKERS, max_per_host: int = DEFAULT_MAX_PER_HOST,
+                 http_client: HTTPClient = None,
+                 gr_per_page: int = DEFAULT_GR_PER_PAGE, gr_page_workers: int = DEFAULT_GR_PAGE_WORKERS,
+                 search_cache: SearchCache = None, search_workers: int = DEFAULT_SEARCH_WORKERS,
+                 libgen_url: str = DEFAULT_LIBGEN_URL, mirror_health: MirrorHealth = None,
+                 shelves: Dict[str, str] = None, retry_backoff_hours: float = DEFAULT_RETRY_BACKOFF_HOURS,
+                 max_retry_backoff_hours: float = DEFAULT_MAX_RETRY_BACKOFF_HOURS,
+                 db_format: str = DEFAULT_DATABASE_FORMAT) -> None:
+        self.http = http_client or HTTPClient()
+        self.db_handler = get_db_handler(db_path, db_format)
+        self.gr_url = gr_url
+        #Shelf name to url, every shelf's books go into the same database
+        #None means just gr_url, an empty dict is a config without any shelf
+        self.shelves = shelves if shelves is not None else {DEFAULT_SHELF: gr_url}
+        self.gr_per_page = gr_per_page
+        self.gr_page_workers = gr_page_workers
+        self.downloads_path = downloads_path
+        self.max_per_host = max_per_host
+        self.search_cache = search_cache
+        self.search_workers = search_workers
+        self.libgen_url = libgen_url
+        self.mirror_health = mirror_health
+        self.workers = workers
+        self.retry_backoff_hours = retry_backoff_hours
+        self.max_retry_backoff_hours = max_retry_backoff_hours
+        #Built on first use so commands that only touch the database don't import requests and bs4
+        self._gr_handlers: Dict[str, "GRHandler"] = {}
+        self._downloader = None
+        self.stop_requested = threading.Event()
     
-    def add_book(self, title: str, author: str, date_added: str, destination: str) -> int:
-        """add a book to the database"""
-        db_response = self.db_handler.read_db()
-        if (db_response.error != SUCCESS): return db_response.error
-        key = title + author
-        db_response.db[destination][key] = {
-            "title": title,
-            "author": author,
-            "date_added": date_added
-        }
-        db_response = self.db_handler.write_db(db_response.db)
-        return db_response.error
+    def gr_handler(self, shelf: str = DEFAULT_SHELF) -> "GRHandler":
+        if (shelf not in self._gr_handlers):
+            from goodreads import GRHandler
+            self._gr_handlers[shelf] = GRHandler(self.shelves[shelf], self.http, self.gr_per_page, self.gr_page_workers)
+        return self._gr_handlers[shelf]
+
+    @property
+    def downloader(self) -> "Downloader":
+        if (self._downloader is None):
+            from downloader import Downloader
+            self._downloader = Downloader(self.downloads_path, self.max_per_host, self.http, self.search_cache,
+                                          self.search_workers, self.libgen_url, self.mirror_health)
+        return self._downloader
+
+    def add_book(self, title: str, author: str, date_added: str = None, destination: str = None) -> int:
+        """add a book to the database, or update the one already there with the fields given"""
+        with self.db_handler.locked():
+            db_response = self.db_handler.read_db()
+            if (db_response.error != SUCCESS): return db_response.error
+            book = {
+                "title": title,
+                "author": author,
+                "date_added": date_added
+            }
+            index = BookIndex(db_response.db)
+            key = index.find(book)
+            if (key is None):
+                index.put(book_id(title, author), destination or "undownloaded_books", book)
+            else:
+                #Adding a book that is already there updates it where it is, keeping its file, owners and priority.
+                #Title and author only identify it, like for remove, the stored spelling is kept
+                bucket = index.bucket(key)
+                record = dict(db_response.db[bucket][key])
+                if (date_added is not None): record["date_added"] = date_added
+                index.put(key, destination or bucket, record)
+            db_response = self.db_handler.write_db(db_response.db)
+            return db_response.error
 
     def remove_book(self, title: str, author: str) -> int:
         """remove a book from the database"""
-        db_response = self.db_handler.read_db()
-        if (db_response.error != SUCCESS): return db_response.error
-
-        swapped_author = author.split(", ")[1] + " " + author.split(", ")[0] if (", " in author) else author.split(" ")[1] + ", " + author.split(" ")[0]
-        removed = False
-        for a in [author, swapped_author]:
-            key = title + a
-            if (key in db_response.db["undownloaded_books"]):
-                del db_response.db["undownloaded_books"][key]
-                removed = True
-            elif (key in db_response.db["downloaded_books"]):
-                del db_response.db["downloaded_books"][key]
-                removed = True
-            elif (key in db_response.db["failed_books"]):
-                del db_response.db["failed_books"][key]
-                removed = True
-            if removed: break
-        if not removed: return NOT_IN_DB
-        db_response = self.db_handler.write_db(db_response.db)
-        return db_response.error
-
-    def update_db(self) -> int:
+        with self.db_handler.locked():
+            db_response = self.db_handler.read_db()
+            if (db_response.error != SUCCESS): return db_response.error
+            index = BookIndex(db_response.db)
+            if not index.remove(index.find({"title": title, "author": author})): return NOT_IN_DB
+            db_response = self.db_handler.write_db(db_response.db)
+            return db_response.error
+
+    def set_priority(self, title: str, author: str, priority: int) -> int:
+        """set how early a book is downloaded, higher first and 0 by default"""
+        with self.db_handler.locked():
+            db_response = self.db_handler.read_db()
+            if (db_response.error != SUCCESS): return db_response.error
+            index = BookIndex(db_response.db)
+            key = index.find({"title": title, "author": author})
+            if (key is None): return NOT_IN_DB
+            db_response.db[index.bucket(key)][key]["priority"] = priority
+            db_response = self.db_handler.write_db(db_response.db)
+            return db_response.error
+
+    def import_books(self, path: Path, destination: str = "undownloaded_books", shelf: str = None) -> ImportResponse:
+        """add every book in a CSV or JSONL file with a single read and write of the database"""
+        with self.db_handler.locked():
+            db_response = self.db_handler.read_db()
+            if (db_response.error != SUCCESS): return ImportResponse(0, 0, 0, db_response.error)
+            index = BookIndex(db_response.db)
+            added, skipped, duplicates = 0, 0, 0
+            try:
+                for book in read_books(path, shelf):
+                    if (book is None):
+                        skipped += 1
+                        continue
+                    if (index.find(book) is not None):
+                        duplicates += 1
+                        continue
+                    index.put(book_id(book["title"], book["author"]), destination, book)
+                    added += 1
+            except (OSError, UnicodeDecodeError, csv.Error):
+                #Nothing is written, so a bad file never leaves a half imported database
+                return ImportResponse(0, 0, 0, FILE_ERROR)
+            if (added): db_response = self.db_handler.write_db(db_response.db)
+            return ImportResponse(added, skipped, duplicates, db_response.error)
+
+    def remove_books(self, path: Path) -> RemoveResponse:
+        """remove every book in a CSV or JSONL file with a single read and write of the database"""
+        with self.db_handler.locked():
+            db_response = self.db_handler.read_db()
+            if (db_response.error != SUCCESS): return RemoveResponse(0, 0, db_response.error)
+            index = BookIndex(db_response.db)
+            removed, missing = 0, 0
+            try:
+                for book in read_books(path):
+                    if (book is not None and index.remove(index.find(book))):
+                        removed += 1
+                    else:
+                        missing += 1
+            except (OSError, UnicodeDecodeError, csv.Error):
+                return RemoveResponse(0, 0, FILE_ERROR)
+            if (removed): db_response = self.db_handler.write_db(db_response.db)
+            return RemoveResponse(removed, missing, db_response.error)
+
+    def update_db(self, full: bool = False) -> int:
         """update the database with the books from goodreads"""
-        gr_response = self.gr_handler.fetch_books()
-        if (gr_response.error != SUCCESS): return gr_response.error
-        db_response = self.db_handler.read_db()
-        if (db_response.error != SUCCESS): return db_response.error
-        for key, book in gr_response.books.items():
-            if (key in db_response.db["undownloaded_books"]): continue
-            if (key in db_response.db["downloaded_books"]): continue
-            if (key in db_response.db["failed_books"]): continue
-            db_response.db["undownloaded_books"][key] = book
-        db_response = self.db_handler.write_db(db_response.db)
-        return db_response.error
-
-    def download_all(self, retry_failed: bool) -> int:
-        """download the books from the database"""
+        return self.sync_shelf(full).error
+
+    def sync_shelf(self, full: bool = False) -> SyncResponse:
+        """merge every shelf into undownloaded_books, returning the keys that were new"""
+        from goodreads import next_watermark
+        if (not self.shelves): return SyncResponse([], NO_SHELF)
+        #The shelves are read against a snapshot, the database isn't held while Goodreads is fetched
         db_response = self.db_handler.read_db()
-        if (db_response.error != SUCCESS): return db_response.error
+        if (db_response.error != SUCCESS): return SyncResponse([], db_response.error)
+        snapshot = db_response.db
+        watermarks = self._watermarks(snapshot)
+        #Copies, a shelf's watermark only moves once all of it has been read
+        new_watermarks = {
+            shelf: None if full or watermarks.get(shelf) is None else dict(watermarks[shelf], keys=list(watermarks[shelf]["keys"]))
+            for shelf in self.shelves
+        }
+        index = BookIndex(snapshot)
+        #Only the books that add a book or an owner are kept, to be merged again under the lock
+        changes = []
+        finished = []
+        error = SUCCESS
+        #Shelves are read concurrently and their books merged here as they arrive, so no shelf is held whole.
+        #They share the HTTP client, so its connection pools and rate limits cover all of them
+        arrivals = queue.Queue(maxsize=SYNC_QUEUE_SIZE)
+        reading = len(self.shelves)
+        with ThreadPoolExecutor(max_workers=len(self.shelves)) as executor:
+            for shelf in self.shelves:
+                executor.submit(self._read_shelf, shelf, None if full else watermarks.get(shelf), arrivals)
+            while reading:
+                shelf, key, book, shelf_error = arrivals.get()
+                if (key is None):
+                    reading -= 1
+                    if (shelf_error == SUCCESS):
+                        finished.append(shelf)
+                        continue
+                    typer.secho(f"Could not fetch all of the {shelf} shelf, the rest will be retried at the next update",
+                                fg=typer.colors.YELLOW)
+                    error = shelf_error
+                    continue
+                existing = index.find(book)
+                if (existing is None or shelf not in snapshot[index.bucket(existing)][existing].get("owners", [])):
+                    changes.append((shelf, key, book))
+                    self._merge_shelf_book(snapshot, index, shelf, key, book)
+                new_watermarks[shelf] = next_watermark(new_watermarks[shelf], key, book)
+
+        #Merged into a fresh read, so whatever other processes wrote meanwhile is kept
+        with self.db_handler.locked():
+            db_response = self.db_handler.read_db()
+            if (db_response.error != SUCCESS): return SyncResponse([], db_response.error)
+            db = db_response.db
+            watermarks = self._watermarks(db)
+            index = BookIndex(db)
+            added = [key for shelf, key, book in changes if self._merge_shelf_book(db, index, shelf, key, book)]
+            for shelf in finished:
+                if (new_watermarks[shelf] is not None): watermarks[shelf] = new_watermarks[shelf]
+            db_response = self.db_handler.write_db(db)
+        return SyncResponse(added, error if error != SUCCESS else db_response.error)
+
+    @staticmethod
+    def _watermarks(db: Dict[str, Any]) -> Dict[str, Any]:
+        watermarks = db.setdefault("sync_watermarks", {})
+        #Databases from before multiple shelves kept one watermark, for the [General] shelf
+        legacy_watermark = db.pop("sync_watermark", None)
+        if (legacy_watermark is not None):
+            watermarks.setdefault(DEFAULT_SHELF, legacy_watermark)
+        return watermarks
+
+    @staticmethod
+    def _merge_shelf_book(db: Dict[str, Any], index: BookIndex, shelf: str, key: str, book: Dict[str, Any]) -> bool:
+        """queue a book from a shelf, returning whether it was new"""
+        #A book on several shelves is queued once and remembers everyone who wants it
+        existing = index.find(book)
+        if (existing is None):
+            index.put(key, "undownloaded_books", dict(book, owners=[shelf]))
+            return True
+        owners = db[index.bucket(existing)][existing].setdefault("owners", [])
+        if (shelf not in owners): owners.append(shelf)
+        return False
 
-        date_since_download = datetime.strptime(db_response.db["date_since_download"], "%m-%d-%Y")
+    def _read_shelf(self, shelf: str, watermark: Dict[str, Any], arrivals: queue.Queue) -> None:
+        """put each book of the shelf on arrivals as it is read, then a None key with the shelf's error"""
+        from goodreads import ShelfError
+        error = GR_ERROR
+        started = time.perf_counter()
+        waited = 0.0
+        try:
+            for key, book in self.gr_handler(shelf).iter_books(watermark):
+                put_started = time.perf_counter()
+                arrivals.put((shelf, key, book, SUCCESS))
+                waited += time.perf_counter() - put_started
+            error = SUCCESS
+        except ShelfError:
+            pass
+        finally:
+            #Time spent waiting for sync_shelf to take the books is the merge's, not the shelf's
+            METRICS.observe("fetch_books", time.perf_counter() - started - waited)
+            #Always sent, sync_shelf waits for one from every shelf
+            arrivals.put((shelf, None, None, error))
 
-        delete_from_undownloaded = []
+    def download_all(self, retry_failed: bool, workers: int = None, keys: Iterable[str] = None,
+                     max_books: int = None, time_budget_minutes: float = None) -> int:
+        """download the books from the database most worth trying first, only those in keys if it is given"""
+        #Results are kept here and merged into a fresh read of the db at the end,
+        #so books the watch loop or other processes added meanwhile aren't overwritten
+        results = []
         source = "undownloaded_books" if not retry_failed else "failed_books"
-        for key, book in db_response.db[source].items():
+        #Read again for every batch
+        keys = None if keys is None else list(keys)
+        workers = workers or self.workers
+        claim = new_claim()
+        #Every book this run claimed, by key
+        to_download = {}
+        error = SUCCESS
+        exhausted = False
+        stopped = False
+        deadline = None if time_budget_minutes is None else time.monotonic() + time_budget_minutes * 60
+        #Downloads run in worker threads, results are merged into the db on this thread only
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {}
+            pending = set()
+            while True:
+                #Books are claimed a batch at a time, topped up before the workers run dry,
+                #so parallel runs share what is left of the queue instead of the first taking all of it
+                if (not exhausted and not stopped and len(pending) <= workers):
+                    limit = CLAIM_BATCH_PER_WORKER * workers
+                    if (max_books is not None): limit = min(limit, max_books - len(to_download))
+                    claim_response = self._claim_books(source, keys, limit, claim, to_download, first=not to_download)
+                    if (claim_response.error != SUCCESS):
+                        if (not to_download): return claim_response.error
+                        error = claim_response.error
+                    exhausted = claim_response.error != SUCCESS or len(claim_response.books) < limit
+                    #The pool starts them in submission order, so the plan's order is the order they run in
+                    for key, book in claim_response.books.items():
+                        to_download[key] = book
+                        future = executor.submit(self.downloader.download, book["title"], book["author"])
+                        futures[future] = key
+                        pending.add(future)
+                if (not pending): break
+                if (not stopped and (self.stop_requested.is_set() or (deadline is not None and time.monotonic() >= deadline))):
+                    #Books that haven't started stay where they are for the next run
+                    stopped = True
+                    deferred = sum(future.cancel() for future in pending)
+                    if (deferred and deadline is not None):
+                        typer.secho(f"Time budget used up, {deferred} books are left for the next run", fg=typer.colors.YELLOW)
+                timeout = None if stopped or deadline is None else deadline - time.monotonic()
+                done, pending = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+                for future in done:
+                    if (future.cancelled()): continue
+                    key = futures[future]
+                    book = to_download[key]
+                    destination, record = self._record_download(book, future)
+                    results.append((key, destination, record))
+                    self._checkpoint(key, destination, record)
 
-            if (book["date_added"] is not None and date_since_download - datetime.strptime(book["date_added"], "%m-%d-%Y") > timedelta(days=1)):
-                #Don't download books added before the last download
-                typer.secho(f"{book["title"]} moved to downloaded because it was added before previous download.")
-                db_response.db["downloaded_books"][key] = book
-                delete_from_undownloaded.append(key)
-                continue
+        if (self.mirror_health is not None):
+            self.mirror_health.save()
 
-            download_response = None
-            try: 
-                #Catch-all to ensure downloads don't stop
-                #Errors should be caught within the download method, but this is a safety
-                download_response = self.downloader.download(book["title"], book["author"])
-            except:
-                typer.secho(f"Error downloading {book["title"]} by {book["author"]}",
-                            fg=typer.colors.RED)
-                db_response.db["failed_books"][key] = book
-                delete_from_undownloaded.append(key)
-                continue
+        with self.db_handler.locked():
+            db_response = self.db_handler.read_db()
+            if (db_response.error != SUCCESS): return db_response.error
+            for key, destination, record in results:
+                apply_checkpoint(db_response.db, key, destination, record)
+            #Books that never started are handed back for the next run, by this process or another
+            finished = {key for key, _, _ in results}
+            for key in to_download:
+                book = db_response.db[source].get(key)
+                if (key in finished or book is None or book.get("claim") != claim): continue
+                db_response.db[source][key] = {field: value for field, value in book.items() if field != "claim"}
+            db_response = self.db_handler.write_db(db_response.db)
+        return error if error != SUCCESS else db_response.error
+
+    def _claim_books(self, source: str, keys: Iterable[str], limit: int, claim: Dict[str, Any],
+                     taken: Dict[str, Any], first: bool = False) -> ClaimResponse:
+        """plan the next books to download, leaving out those in taken, and claim them so other runs leave them alone"""
+        if (limit <= 0): return ClaimResponse({}, SUCCESS)
+        #Planning and claiming happen under the lock, so two runs can't claim the same book
+        with self.db_handler.locked():
+            db_response = self.db_handler.read_db()
+            if (db_response.error != SUCCESS): return ClaimResponse({}, db_response.error)
+            db = db_response.db
+            date_since_download = datetime.strptime(db["date_since_download"], "%m-%d-%Y")
+
+            books = db[source]
+            if (keys is not None):
+                books = {key: books[key] for key in keys if key in books}
+            candidates = {}
+            moved = {}
+            claimed_elsewhere = 0
+            for key, book in books.items():
+                if (key in taken): continue
+                if (is_claimed(book)):
+                    claimed_elsewhere += 1
+                    continue
+                #Without a stale claim, so records written from it don't carry one
+                book = {field: value for field, value in book.items() if field != "claim"}
+
+                if (book["date_added"] is not None and not book.get("requeued") and date_since_download - datetime.strptime(book["date_added"], "%m-%d-%Y") > timedelta(days=1)):
+                    #Don't download books added before the last download
+                    typer.secho(f"{book["title"]} moved to downloaded because it was added before previous download.")
+                    moved[key] = book
+                    continue
+                candidates[key] = book
+
+            download_plan = plan(candidates, limit, backoff_hours=self.retry_backoff_hours,
+                                 max_backoff_hours=self.max_retry_backoff_hours)
+            for key, book in moved.items():
+                apply_checkpoint(db, key, "downloaded_books", book)
+            for key in download_plan.keys:
+                db[source][key] = dict(candidates[key], claim=claim)
+            if (moved or download_plan.keys):
+                db_response = self.db_handler.write_db(db)
+                if (db_response.error != SUCCESS): return ClaimResponse({}, db_response.error)
+
+        if (first and claimed_elsewhere):
+            typer.secho(f"{claimed_elsewhere} books are being downloaded by another goldfinch and are skipped",
+                        fg=typer.colors.YELLOW)
+        if (first and download_plan.backing_off):
+            typer.secho(f"{download_plan.backing_off} books failed recently and are skipped, the next can be retried after {download_plan.next_due:%m-%d-%Y %H:%M}",
+                        fg=typer.colors.YELLOW)
+            METRICS.count("books_backing_off", download_plan.backing_off)
+        #Again for every batch, so files other runs downloaded meanwhile aren't fetched twice
+        self.downloader.index_files(db["downloaded_books"].values())
+        return ClaimResponse({key: candidates[key] for key in download_plan.keys}, SUCCESS)
+
+    def watch(self, interval_minutes: float = DEFAULT_WATCH_INTERVAL_MINUTES, jitter: float = DEFAULT_WATCH_JITTER,
+              workers: int = None) -> int:
+        """poll the shelf until stop() is called, downloading new books as soon as they are found"""
+        download_queue = queue.Queue()
+        downloader = threading.Thread(target=self._download_from_queue, args=(download_queue, workers), daemon=True)
+        downloader.start()
+
+        #Pick up whatever previous runs left behind before the first poll
+        db_response = self.db_handler.read_db()
+        if (db_response.error != SUCCESS):
+            self.stop()
+            downloader.join()
+            return db_response.error
+        for key in db_response.db["undownloaded_books"]:
+            download_queue.put(key)
 
-            if (download_response.error != SUCCESS): 
-                typer.secho(f"Error downloading {book["title"]} by {book["author"]} because of {ERRORS[download_response.error]}",
+        while not self.stop_requested.is_set():
+            sync_response = self.sync_shelf()
+            if (sync_response.error != SUCCESS):
+                typer.secho(f"update failed with {ERRORS[sync_response.error]}, retrying at the next poll",
                             fg=typer.colors.RED)
-                db_response.db["failed_books"][key] = book
-                delete_from_undownloaded.append(key)
+            elif (sync_response.added):
+                typer.secho(f"{len(sync_response.added)} new books found", fg=typer.colors.GREEN)
+            for key in sync_response.added:
+                download_queue.put(key)
+            #Jitter keeps several instances from hitting Goodreads in lockstep
+            delay = interval_minutes * 60 * (1 + random.uniform(-jitter, jitter))
+            self.stop_requested.wait(max(delay, 0))
+
+        downloader.join()
+        return SUCCESS
+
+    def stop(self) -> None:
+        """ask watch to finish the books in progress and return"""
+        self.stop_requested.set()
+
+    def _download_from_queue(self, download_queue: queue.Queue, workers: int) -> None:
+        while not self.stop_requested.is_set():
+            try:
+                keys = [download_queue.get(timeout=1)]
+            except queue.Empty:
                 continue
+            #Books found by the same poll are downloaded together
+            while not download_queue.empty():
+                keys.append(download_queue.get_nowait())
+            error = self.download_all(False, workers, keys)
+            if (error != SUCCESS):
+                typer.secho(f"downloads failed with {ERRORS[error]}", fg=typer.colors.RED)
 
-            db_response.db["downloaded_books"][key] = {
-                "title": book["title"],
-                "author": book["author"],
-                "date_added": book["date_added"],
-                "date_downloaded": download_response.date_downloaded,
-                "link": download_response.link
-            }
-            delete_from_undownloaded.append(key)
-            typer.secho(f"{book["title"]} downloaded successfully",
-                        fg=typer.colors.GREEN)
+    def verify(self, requeue: bool = False, workers: int = None) -> VerifyResponse:
+        """check every downloaded file in parallel, moving broken ones back to undownloaded_books if requeue is set"""
+        db_response = self.db_handler.read_db()
+        if (db_response.error != SUCCESS): return VerifyResponse(0, {}, db_response.error)
+        #Only books goldfinch downloaded itself have a file, not ones moved to downloaded by date or by hand
+        books = {key: book for key, book in db_response.db["downloaded_books"].items() if book.get("link")}
+        with ThreadPoolExecutor(max_workers=workers or self.workers) as executor:
+            results = executor.map(lambda book: verify_file(self._book_path(book), book), books.values())
+            problems = {key: problem for key, problem in zip(books, results) if problem is not None}
+        METRICS.count("files_verified", len(books))
+        METRICS.count("files_broken", len(problems))
+        if (not requeue or not problems):
+            return VerifyResponse(len(books), problems, SUCCESS)
 
-        for key in delete_from_undownloaded:
-            if key in db_response.db["undownloaded_books"]:
-                del db_response.db["undownloaded_books"][key]
+        with self.db_handler.locked():
+            db_response = self.db_handler.read_db()
+            if (db_response.error != SUCCESS): return VerifyResponse(len(books), problems, db_response.error)
+            index = BookIndex(db_response.db)
+            for key in problems:
+                if (index.bucket(key) != "downloaded_books"): continue
+                book = db_response.db["downloaded_books"][key]
+                self._book_path(book).unlink(missing_ok=True)
+                record = {field: value for field, value in book.items() if field not in ATTEMPT_FIELDS + FILE_FIELDS}
+                record["requeued"] = problems[key]
+                index.put(key, "undownloaded_books", record)
+            db_response = self.db_handler.write_db(db_response.db)
+        return VerifyResponse(len(books), problems, db_response.error)
 
-        db_response = self.db_handler.write_db(db_response.db)
-        return db_response.error
+    def _book_path(self, book: Dict[str, Any]) -> Path:
+        if (book.get("path")): return Path(book["path"])
+        #Downloaded before files were named by format
+        return self.downloads_path / f"{book['title'].replace(' ', '_')}.epub"
+
+    def _checkpoint(self, key: str, destination: str, record: Dict[str, Any]) -> None:
+        """persist a single book's result so an interrupted run resumes where it stopped"""
+        if (self.db_handler.checkpoint(key, destination, record) != SUCCESS):
+            typer.secho(f"Could not checkpoint {record["title"]}, it will be saved at the end of the run",
+                        fg=typer.colors.YELLOW)
+
+    def _record_download(self, book: Dict[str, Any], future: Future) -> Tuple[str, Dict[str, Any]]:
+        """decide between downloaded_books and failed_books from the result of a download, returning where the book goes and its record"""
+        download_response = None
+        try: 
+            #Catch-all to ensure downloads don't stop
+            #Errors should be caught within the download method, but this is a safety
+            download_response = future.result()
+        except Exception as error:
+            typer.secho(f"Error downloading {book["title"]} by {book["author"]}",
+                        fg=typer.colors.RED)
+            METRICS.count("books_failed")
+            return "failed_books", record_failure(book, f"unexpected {type(error).__name__}")
+
+        if (download_response.error != SUCCESS): 
+            typer.secho(f"Error downloading {book["title"]} by {book["author"]} because of {ERRORS[download_response.error]}",
+                        fg=typer.colors.RED)
+            METRICS.count("books_failed")
+            return "failed_books", record_failure(book, ERRORS[download_response.error])
+
+        #Everything known about the book, its ids included, so the index can still find it, but not how earlier attempts went
+        record = {field: value for field, value in book.items() if field not in ATTEMPT_FIELDS + FILE_FIELDS}
+        record["date_downloaded"] = download_response.date_downloaded
+        record["link"] = download_response.link
+        if (download_response.file is not None):
+            record["path"] = str(download_response.file.path)
+            record["md5"] = download_response.file.md5
+            record["size"] = download_response.file.size
+            record["format"] = download_response.file.format
+        typer.secho(f"{book["title"]} downloaded successfully",
+                    fg=typer.colors.GREEN)
+        METRICS.count("books_downloaded")
+        return "downloaded_books", record
     
-    def list(self, source : str = None) -> int:
+    def list(self, query: BookQuery = BookQuery(), output_format: str = "text", count: bool = False) -> int:
         """list books in database"""
-        db_response = self.db_handler.read_db()
-        if (db_response.error != SUCCESS): return db_response.error
-        if (source == None):
-            typer.secho("Undownloaded Books", fg=typer.colors.GREEN)
-            for key, book in db_response.db["undownloaded_books"].items():
-                typer.secho(f"\t{book['title']} by {book['author']}", fg=typer.colors.WHITE)
-            typer.secho("Downloaded Books", fg=typer.colors.GREEN)
-            for key, book in db_response.db["downloaded_books"].items():
-                typer.secho(f"\t{book['title']} by {book['author']}", fg=typer.colors.WHITE)
-            typer.secho("Failed Books", fg=typer.colors.GREEN)
-            for key, book in db_response.db["failed_books"].items():
-                typer.secho(f"\t{book['title']} by {book['author']}", fg=typer.colors.WHITE)
-        else:
-            typer.secho(f"{source.replace("_", " ")} Books", fg=typer.colors.GREEN)
-            for key, book in db_response.db[source].items():
-                typer.secho(f"{book['title']} by {book['author']}", fg=typer.colors.WHITE)
+        if (count):
+            count_response = self.db_handler.count_books(query)
+            if (count_response.error != SUCCESS): return count_response.error
+            typer.echo(count_response.count)
+            return SUCCESS
+        books_response = self.db_handler.select_books(query)
+        if (books_response.error != SUCCESS): return books_response.error
+        #Text output without a sort keeps the old layout, a heading per bucket
+        headings = query.buckets if (output_format == "text" and query.sort is None) else ()
+        typer.echo(format_books(books_response.books, output_format, headings), nl=False)
+        return SUCCESS
 
     def get_gr_url(self) -> str:
-        url = self.gr_handler.get_url()
-        return url
+        return self.gr_url
     
     def set_gr_url(self, url: str) -> None:
-        self.gr_handler.set_url(url)
\ No newline at end of file
+        self.gr_url = url
+        self.shelves[DEFAULT_SHELF] = url
+        if (DEFAULT_SHELF in self._gr_handlers):
+            self._gr_handlers[DEFAULT_SHELF].set_url(url)
\ No newline at end of file
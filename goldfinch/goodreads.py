@@ -1,20 +1,122 @@
 # goldfinch/goodreads.py
 
 import requests
-from bs4 import BeautifulSoup
-from typing import Dict, NamedTuple
+from typing import Any, Dict, Iterator, List, Optional, Tuple
 from datetime import datetime
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from html.parser import HTMLParser
+import codecs
+import itertools
+import urllib.parse
 import re
+import time
 
-from __init__ import GR_ERROR, SUCCESS
+from http_client import HTTPClient
+from metrics import METRICS
+from identity import book_id
+from config import DEFAULT_GR_PER_PAGE, DEFAULT_GR_PAGE_WORKERS
 
-class GRResponse(NamedTuple):
-    error: int
-    books: Dict[str, Dict[str, str]]
+BRACKETS_PATTERN = re.compile(r"[\[({].*[\])}]")
+BOOK_ID_PATTERN = re.compile(r"/book/show/(\d+)")
+CHUNK_SIZE = 64 * 1024
+HEADERS = {'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_11_5) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/50.0.2661.102 Safari/537.36'}
+
+class ShelfError(Exception):
+    """a shelf page that couldn't be fetched or read"""
+
+class ShelfParser(HTMLParser):
+    """collects the book rows and page count of a shelf page as it is fed, without building a tree"""
+    def __init__(self) -> None:
+        super().__init__(convert_charrefs=True)
+        #Rows finished since the reader last took them, each the text of its cells and the title link
+        self.rows: List[Tuple[Dict[str, str], Optional[str]]] = []
+        self.last_page = 1
+        self._cells: Optional[Dict[str, List[str]]] = None
+        self._field: Optional[str] = None
+        self._link: Optional[str] = None
+        self._pagination_depth = 0
+        self._page_text: Optional[List[str]] = None
+
+    def handle_starttag(self, tag: str, attrs: list) -> None:
+        attrs = dict(attrs)
+        classes = (attrs.get("class") or "").split()
+        if (tag == "tr" and "bookalike" in classes and "review" in classes):
+            self._cells, self._link = {}, None
+        elif (tag == "td" and self._cells is not None and "field" in classes):
+            self._field = classes[-1]
+            self._cells[self._field] = []
+        elif (tag == "a" and self._field == "title" and self._link is None and attrs.get("href")):
+            self._link = attrs["href"]
+        elif (tag == "div" and (self._pagination_depth or attrs.get("id") == "reviewPagination")):
+            self._pagination_depth += 1
+        elif (tag == "a" and self._pagination_depth):
+            self._page_text = []
+
+    def handle_endtag(self, tag: str) -> None:
+        if (tag == "td"):
+            self._field = None
+        elif (tag == "tr" and self._cells is not None):
+            self.rows.append(({field: "".join(text) for field, text in self._cells.items()}, self._link))
+            self._cells = None
+        elif (tag == "div" and self._pagination_depth):
+            self._pagination_depth -= 1
+        elif (tag == "a" and self._page_text is not None):
+            text = "".join(self._page_text).strip()
+            if (text.isdigit()): self.last_page = max(self.last_page, int(text))
+            self._page_text = None
+
+    def handle_data(self, data: str) -> None:
+        if (self._field is not None):
+            self._cells[self._field].append(data)
+        if (self._page_text is not None):
+            self._page_text.append(data)
+
+    def take_rows(self) -> List[Tuple[Dict[str, str], Optional[str]]]:
+        rows, self.rows = self.rows, []
+        return rows
+
+def book_from_row(cells: Dict[str, str], link: Optional[str]) -> Tuple[str, Dict[str, str]]:
+    """the key and record of the book in a shelf row"""
+    #Cell text starts with the cell's label, e.g. "title" or "date added"
+    title = cells["title"][5:].strip().replace("\n", "")
+    title = BRACKETS_PATTERN.sub("", title).strip()
+
+    author = cells["author"][6:].strip().replace("\n", "")
+    author = author.replace("*", "")
+
+    date_added = cells["date_added"][10:].strip().replace("\n", "")
+    date_time = datetime.strptime(date_added, "%b %d, %Y")
+    date_added = date_time.strftime("%m-%d-%Y")
+
+    book = {
+        "title": title,
+        "author": author,
+        "date_added": date_added
+    }
+    #Kept so a book Goodreads renames is still recognised
+    match = BOOK_ID_PATTERN.search(link) if link is not None else None
+    if (match is not None):
+        book["goodreads_id"] = match.group(1)
+    isbn = cells.get("isbn", "")[4:].strip()
+    if (isbn):
+        book["isbn"] = isbn
+    return book_id(title, author), book
+
+def parse_shelf(content: str) -> Dict[str, Dict[str, str]]:
+    """every book on a whole shelf page"""
+    parser = ShelfParser()
+    parser.feed(content)
+    parser.close()
+    return dict(book_from_row(cells, link) for cells, link in parser.take_rows())
 
 class GRHandler():
-    def __init__(self, gr_url: str) -> None:
+    def __init__(self, gr_url: str, http_client: HTTPClient = None,
+                 per_page: int = DEFAULT_GR_PER_PAGE, page_workers: int = DEFAULT_GR_PAGE_WORKERS) -> None:
         self.url = gr_url
+        self.http = http_client or HTTPClient()
+        self.per_page = per_page
+        self.page_workers = page_workers
 
     def get_url(self) -> str:
         return self.url
@@ -23,33 +125,95 @@ class GRHandler():
         print(new_url)
         self.url = new_url
     
-    def fetch_books(self) -> GRResponse:
+    def page_url(self, page: int) -> str:
+        """return the shelf url for the given page"""
+        parts = urllib.parse.urlsplit(self.url)
+        query = dict(urllib.parse.parse_qsl(parts.query))
+        query["page"] = str(page)
+        query["per_page"] = str(self.per_page)
+        query["sort"] = "date_added"
+        query["order"] = "d"
+        return urllib.parse.urlunsplit(parts._replace(query=urllib.parse.urlencode(query)))
+
+    def _read_page(self, page: int, parser: ShelfParser) -> Iterator[Tuple[str, Dict[str, str]]]:
+        """yield the books on a page as its rows arrive, parser.last_page is known once it is exhausted"""
+        #Only the time spent fetching and parsing is timed, not what the reader does between books
+        seconds = 0.0
+        resumed = time.perf_counter()
         try:
-            headers = {'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_11_5) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/50.0.2661.102 Safari/537.36'}
-            request = requests.get(self.url, headers=headers)
-        except requests.RequestException:
-            return GRResponse(GR_ERROR, {})
-        if (request.status_code != 200): 
-            return GRResponse(GR_ERROR, {})
-        soup = BeautifulSoup(request.content, "html.parser")
-        results = soup.find_all("tr", class_ = "bookalike review")
-        books = {}
-        for item in results:
-            title = item.find("td", class_ = "field title").text[5:].strip().replace("\n", "")
-            brackets_pattern = re.compile(r"[\[({].*[\])}]")
-            title = brackets_pattern.sub("", title).strip()
-
-            author = item.find("td", class_ = "field author").text[6:].strip().replace("\n", "")
-            author = author.replace("*", "")
-            
-            date_added = item.find("td", class_ = "field date_added").text[10:].strip().replace("\n", "")
-            date_time = datetime.strptime(date_added, "%b %d, %Y")
-            date_added = date_time.strftime("%m-%d-%Y")
-
-            key = title + author
-            books[key] = {
-                "title": title,
-                "author": author,
-                "date_added": date_added
-            }
-        return GRResponse(SUCCESS, books)
+            with self.http.get(self.page_url(page), headers=HEADERS, stream=True) as response:
+                if (response.status_code != 200):
+                    raise ShelfError(f"page {page} returned {response.status_code}")
+                #Without a charset in the headers requests assumes latin-1, Goodreads pages are utf-8
+                encoding = response.encoding if "charset" in response.headers.get("Content-Type", "") else "utf-8"
+                decoder = codecs.getincrementaldecoder(encoding)(errors="replace")
+                for chunk in itertools.chain(response.iter_content(CHUNK_SIZE), [None]):
+                    parser.feed(decoder.decode(chunk or b"", final=chunk is None))
+                    for cells, link in parser.take_rows():
+                        book = book_from_row(cells, link)
+                        seconds += time.perf_counter() - resumed
+                        resumed = None
+                        yield book
+                        resumed = time.perf_counter()
+                parser.close()
+        except requests.RequestException as error:
+            raise ShelfError(f"page {page} could not be fetched") from error
+        except (KeyError, ValueError) as error:
+            raise ShelfError(f"page {page} has a row that couldn't be read") from error
+        finally:
+            if (resumed is not None): seconds += time.perf_counter() - resumed
+            METRICS.observe("fetch_page", seconds)
+
+    def _read_whole_page(self, page: int) -> List[Tuple[str, Dict[str, str]]]:
+        return list(self._read_page(page, ShelfParser()))
+
+    def iter_books(self, watermark: Optional[Dict[str, Any]] = None) -> Iterator[Tuple[str, Dict[str, str]]]:
+        """yield the key and record of each book on the shelf as it is read, only the ones added since watermark
+        if one is given; raises ShelfError if a page fails, after the books before it were yielded"""
+        if (watermark is not None):
+            return self._iter_new_books(watermark)
+        return self._iter_all_books()
+
+    def _iter_all_books(self) -> Iterator[Tuple[str, Dict[str, str]]]:
+        """read the first page to learn the page count, the pages after it are fetched concurrently"""
+        first_page = ShelfParser()
+        yield from self._read_page(1, first_page)
+        pages = iter(range(2, first_page.last_page + 1))
+        with ThreadPoolExecutor(max_workers=self.page_workers) as executor:
+            #Only page_workers pages are held at a time however long the shelf is
+            window = deque(executor.submit(self._read_whole_page, page) for page in itertools.islice(pages, self.page_workers))
+            while window:
+                books = window.popleft().result()
+                next_page = next(pages, None)
+                if (next_page is not None):
+                    window.append(executor.submit(self._read_whole_page, next_page))
+                yield from books
+
+    def _iter_new_books(self, watermark: Dict[str, Any]) -> Iterator[Tuple[str, Dict[str, str]]]:
+        """walk the shelf newest first, stopping at the first book added before the watermark"""
+        watermark_date = datetime.strptime(watermark["date_added"], "%m-%d-%Y")
+        known_keys = set(watermark["keys"])
+        page = 1
+        while True:
+            parser = ShelfParser()
+            for key, book in self._read_page(page, parser):
+                date_added = datetime.strptime(book["date_added"], "%m-%d-%Y")
+                if (date_added < watermark_date): return
+                if (date_added == watermark_date and key in known_keys): continue
+                yield key, book
+            if (page >= parser.last_page): return
+            page += 1
+
+def next_watermark(watermark: Optional[Dict[str, Any]], key: str, book: Dict[str, str]) -> Dict[str, Any]:
+    """the watermark once book has been seen, the newest date_added and the keys added on that date; updates watermark in place"""
+    if (watermark is not None):
+        newest = datetime.strptime(watermark["date_added"], "%m-%d-%Y")
+        date_added = datetime.strptime(book["date_added"], "%m-%d-%Y")
+        if (date_added < newest): return watermark
+        if (date_added == newest):
+            if (key not in watermark["keys"]): watermark["keys"].append(key)
+            return watermark
+    return {
+        "date_added": book["date_added"],
+        "keys": [key]
+    }
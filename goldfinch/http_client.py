@@ -0,0 +1,174 @@
+# goldfinch/http_client.py
+
+import threading
+import time
+import urllib.parse
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Dict, Optional
+
+from metrics import METRICS
+from config import DEFAULT_HTTP_TIMEOUT, DEFAULT_HTTP_RETRIES, DEFAULT_HTTP_BACKOFF_FACTOR, DEFAULT_HTTP_CONNECTIONS_PER_HOST
+from config import DEFAULT_HTTP_REQUESTS_PER_SECOND, DEFAULT_HTTP_BURST, DEFAULT_HTTP_MAX_RETRY_AFTER
+
+#Server errors worth another try, retried in get so every attempt takes a token from the host's bucket
+RETRY_STATUSES = (500, 502, 504)
+#Answers that mean "slow down", retried here so the whole host is paused and not just one request
+THROTTLE_STATUSES = (429, 503)
+#A throttled host is slowed to no less than this fraction of its configured rate
+MIN_RATE_FRACTION = 0.1
+#Fraction of the configured rate won back with every successful request
+RECOVERY_STEP = 0.05
+
+class TokenBucket:
+    """a rate of 0 never runs out of tokens, but still honours pauses"""
+    def __init__(self, rate: float, burst: int) -> None:
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+class RateLimiter:
+    """per-host token buckets shared by every request, halving a host's rate when it pushes back"""
+    def __init__(self, requests_per_second: float = DEFAULT_HTTP_REQUESTS_PER_SECOND, burst: int = DEFAULT_HTTP_BURST,
+                 host_rates: Dict[str, float] = None) -> None:
+        self.requests_per_second = requests_per_second
+        self.burst = max(burst, 1)
+        self.host_rates = host_rates or {}
+        self._buckets: Dict[str, TokenBucket] = {}
+        self._lock = threading.Lock()
+
+    def _bucket(self, host: str) -> TokenBucket:
+        if (host not in self._buckets):
+            self._buckets[host] = TokenBucket(max(self.host_rates.get(host, self.requests_per_second), 0.0), self.burst)
+        return self._buckets[host]
+
+    def acquire(self, host: str) -> None:
+        """block until host may be sent another request"""
+        while True:
+            with self._lock:
+                bucket = self._bucket(host)
+                now = time.monotonic()
+                wait = bucket.paused_until - now
+                if (bucket.rate == 0):
+                    if (wait <= 0): return
+                else:
+                    bucket.tokens = min(bucket.burst, bucket.tokens + (now - bucket.updated) * bucket.rate)
+                    bucket.updated = now
+                    if (wait <= 0 and bucket.tokens >= 1):
+                        bucket.tokens -= 1
+                        return
+                    wait = max(wait, (1 - bucket.tokens) / bucket.rate)
+            time.sleep(wait)
+
+    def throttle(self, host: str, delay: float) -> None:
+        """host asked us to back off, hold every request to it for delay seconds and slow down afterwards"""
+        with self._lock:
+            bucket = self._bucket(host)
+            bucket.paused_until = max(bucket.paused_until, time.monotonic() + delay)
+            bucket.rate = max(bucket.max_rate * MIN_RATE_FRACTION, bucket.rate / 2)
+            bucket.tokens = 0.0
+
+    def succeeded(self, host: str) -> None:
+        with self._lock:
+            bucket = self._bucket(host)
+            bucket.rate = min(bucket.max_rate, bucket.rate + bucket.max_rate * RECOVERY_STEP)
+
+def retry_after(response: "requests.Response") -> Optional[float]:
+    """seconds a Retry-After header asks for, given either as a number or as an HTTP date"""
+    value = response.headers.get("Retry-After")
+    if (value is None): return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max((parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+class HTTPClient:
+    """pooled keep-alive session shared by every network call goldfinch makes"""
+    def __init__(
+        self,
+        timeout: float = DEFAULT_HTTP_TIMEOUT,
+        retries: int = DEFAULT_HTTP_RETRIES,
+        backoff_factor: float = DEFAULT_HTTP_BACKOFF_FACTOR,
+        max_connections_per_host: int = DEFAULT_HTTP_CONNECTIONS_PER_HOST,
+        rate_limiter: RateLimiter = None,
+        max_retry_after: float = DEFAULT_HTTP_MAX_RETRY_AFTER,
+    ) -> None:
+        self.timeout = timeout
+        self.rate_limiter = rate_limiter or RateLimiter()
+        self.max_retry_after = max_retry_after
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.max_connections_per_host = max_connections_per_host
+        self._session = None
+        self._lock = threading.Lock()
+
+    @property
+    def session(self) -> "requests.Session":
+        """the session is built on first use, so commands that never go online don't import requests"""
+        if (self._session is None):
+            with self._lock:
+                if (self._session is None):
+                    self._session = self._build_session()
+        return self._session
+
+    def _build_session(self) -> "requests.Session":
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        #pool_block makes pool_maxsize a hard cap on open connections per host,
+        #retries are left to get so they go through the rate limiter
+        adapter = HTTPAdapter(
+            pool_maxsize=self.max_connections_per_host,
+            pool_block=True,
+            max_retries=0,
+        )
+        session = requests.Session()
+        session.headers["Accept-Encoding"] = "gzip, deflate"
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+    def get(self, url: str, **kwargs) -> "requests.Response":
+        import requests
+
+        kwargs.setdefault("timeout", self.timeout)
+        host = urllib.parse.urlsplit(url).netloc
+        attempt = 0
+        while True:
+            self.rate_limiter.acquire(host)
+            try:
+                response = self.session.get(url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                if (attempt >= self.retries): raise
+                METRICS.count("http_retried")
+                time.sleep(self.backoff_factor * (2 ** attempt))
+                attempt += 1
+                continue
+            if (response.status_code not in THROTTLE_STATUSES + RETRY_STATUSES):
+                self.rate_limiter.succeeded(host)
+                return response
+            if (attempt >= self.retries):
+                return response
+            response.close()
+            if (response.status_code in RETRY_STATUSES):
+                #A broken server isn't asking us to slow down, so only this request waits
+                METRICS.count("http_retried")
+                time.sleep(self.backoff_factor * (2 ** attempt))
+                attempt += 1
+                continue
+            METRICS.count("http_throttled")
+            delay = retry_after(response)
+            if (delay is None): delay = self.backoff_factor * (2 ** attempt)
+            self.rate_limiter.throttle(host, min(delay, self.max_retry_after))
+            attempt += 1
+
+    def close(self) -> None:
+        if (self._session is not None):
+            self._session.close()
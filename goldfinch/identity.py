@@ -0,0 +1,76 @@
+# goldfinch/identity.py
+
+from typing import Any, Dict, Optional
+
+from ranking import normalize
+
+KEY_VERSION = 2
+#When the same book is in several buckets, the first of these keeps it
+BUCKET_PRECEDENCE = ("downloaded_books", "failed_books", "undownloaded_books")
+ALIAS_FIELDS = ("goodreads_id", "isbn")
+
+def book_id(title: str, author: str) -> str:
+    """canonical key of a book, the same for "Dune (Dune, #1)" by "Herbert, Frank" and "dune" by "Frank Herbert" """
+    return normalize(title) + "|" + " ".join(sorted(normalize(author).split()))
+
+def upgrade_keys(db: Dict[str, Any]) -> Dict[str, Any]:
+    """re-key a database written before canonical ids, merging books that turn out to be the same"""
+    if (db.get("key_version") == KEY_VERSION): return db
+    new_keys = {}
+    seen = set()
+    rekeyed = {bucket: {} for bucket in BUCKET_PRECEDENCE}
+    for bucket in BUCKET_PRECEDENCE:
+        for old_key, record in db[bucket].items():
+            key = book_id(record["title"], record["author"])
+            new_keys[old_key] = key
+            if (key in seen): continue
+            seen.add(key)
+            rekeyed[bucket][key] = record
+    db.update(rekeyed)
+    watermarks = [db.get("sync_watermark")] + list((db.get("sync_watermarks") or {}).values())
+    for watermark in watermarks:
+        if (watermark is None): continue
+        watermark["keys"] = list(dict.fromkeys(new_keys[key] for key in watermark["keys"] if key in new_keys))
+    db["key_version"] = KEY_VERSION
+    return db
+
+class BookIndex:
+    """one lookup from a book id, Goodreads id or ISBN to the bucket holding the book"""
+    def __init__(self, db: Dict[str, Any]) -> None:
+        self.db = db
+        self.buckets: Dict[str, str] = {}
+        self.aliases: Dict[str, str] = {}
+        for bucket in reversed(BUCKET_PRECEDENCE):
+            for key, record in db[bucket].items():
+                self._index(key, bucket, record)
+
+    def _index(self, key: str, bucket: str, record: Dict[str, Any]) -> None:
+        self.buckets[key] = bucket
+        for field in ALIAS_FIELDS:
+            if (record.get(field)): self.aliases[f"{field}:{record[field]}"] = key
+
+    def find(self, book: Dict[str, Any]) -> Optional[str]:
+        """the key the book is stored under, None if it isn't in the database"""
+        key = book_id(book["title"], book["author"])
+        if (key in self.buckets): return key
+        for field in ALIAS_FIELDS:
+            alias_key = self.aliases.get(f"{field}:{book.get(field)}") if book.get(field) else None
+            if (alias_key in self.buckets): return alias_key
+        return None
+
+    def bucket(self, key: str) -> Optional[str]:
+        return self.buckets.get(key)
+
+    def put(self, key: str, bucket: str, record: Dict[str, Any]) -> None:
+        """store record under key in bucket, moving it out of any other bucket"""
+        previous = self.buckets.get(key)
+        if (previous is not None and previous != bucket):
+            del self.db[previous][key]
+        self.db[bucket][key] = record
+        self._index(key, bucket, record)
+
+    def remove(self, key: str) -> bool:
+        bucket = self.buckets.pop(key, None)
+        if (bucket is None): return False
+        del self.db[bucket][key]
+        return True
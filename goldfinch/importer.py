@@ -0,0 +1,93 @@
+# goldfinch/importer.py
+
+import csv
+import json
+import re
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, Iterator, NamedTuple, Optional
+
+JSONL_SUFFIXES = (".jsonl", ".ndjson")
+#Same cleanup the shelf parser does, so imported books get the keys update_db would give them
+BRACKETS_PATTERN = re.compile(r"[\[({].*[\])}]")
+DATE_FORMATS = ("%Y/%m/%d", "%Y-%m-%d", "%m-%d-%Y", "%m/%d/%Y")
+#Goodreads library exports have both; "Author l-f" matches the "Last, First" names on shelf pages
+TITLE_COLUMNS = ("title",)
+AUTHOR_COLUMNS = ("author l-f", "author")
+DATE_COLUMNS = ("date_added", "date added")
+SHELF_COLUMNS = ("exclusive shelf", "shelf")
+GOODREADS_ID_COLUMNS = ("goodreads_id", "book id")
+ISBN_COLUMNS = ("isbn", "isbn13")
+
+class ImportResponse(NamedTuple):
+    added: int
+    skipped: int
+    duplicates: int
+    error: int
+
+class RemoveResponse(NamedTuple):
+    removed: int
+    missing: int
+    error: int
+
+def read_books(path: Path, shelf: str = None) -> Iterator[Optional[Dict[str, Any]]]:
+    """yield a book for each row of a CSV or JSONL file, or None for rows that can't be used"""
+    rows = _read_jsonl(path) if path.suffix.lower() in JSONL_SUFFIXES else _read_csv(path)
+    for row in rows:
+        if (row is None):
+            yield None
+            continue
+        row = {str(column).strip().lower(): value for column, value in row.items()}
+        if (shelf is not None and _first(row, SHELF_COLUMNS) not in (None, shelf)):
+            yield None
+            continue
+        title = BRACKETS_PATTERN.sub("", _first(row, TITLE_COLUMNS) or "").strip()
+        author = (_first(row, AUTHOR_COLUMNS) or "").replace("*", "").strip()
+        if (not title or not author):
+            yield None
+            continue
+        book = {
+            "title": title,
+            "author": author,
+            "date_added": _parse_date(_first(row, DATE_COLUMNS))
+        }
+        goodreads_id = _first(row, GOODREADS_ID_COLUMNS)
+        if (goodreads_id is not None):
+            book["goodreads_id"] = goodreads_id
+        #Goodreads exports ISBNs as ="0441172717" so spreadsheets keep the leading zero
+        isbns = [str(row.get(column) or "").strip().strip('="') for column in ISBN_COLUMNS]
+        isbn = next((isbn for isbn in isbns if isbn), None)
+        if (isbn is not None):
+            book["isbn"] = isbn
+        yield book
+
+def _read_csv(path: Path) -> Iterator[Dict[str, Any]]:
+    #utf-8-sig drops the byte order mark spreadsheet programs put in front of the header
+    with path.open("r", newline="", encoding="utf-8-sig") as file:
+        yield from csv.DictReader(file)
+
+def _read_jsonl(path: Path) -> Iterator[Optional[Dict[str, Any]]]:
+    with path.open("r", encoding="utf-8") as file:
+        for line in file:
+            if (not line.strip()): continue
+            try:
+                row = json.loads(line)
+            except json.JSONDecodeError:
+                yield None
+                continue
+            yield row if isinstance(row, dict) else None
+
+def _first(row: Dict[str, Any], columns: tuple) -> Optional[str]:
+    for column in columns:
+        value = row.get(column)
+        if (value is not None and str(value).strip()): return str(value).strip()
+    return None
+
+def _parse_date(value: Optional[str]) -> Optional[str]:
+    if (value is None): return None
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.strptime(value, date_format).strftime("%m-%d-%Y")
+        except ValueError:
+            continue
+    return None
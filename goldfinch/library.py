@@ -0,0 +1,71 @@
+# goldfinch/library.py
+
+import hashlib
+import re
+import zipfile
+from pathlib import Path
+from typing import Any, Dict, NamedTuple, Optional
+
+READ_SIZE = 1024 * 1024
+#Enough of the start of a file to tell every format below apart
+HEADER_SIZE = 68
+MD5_PATTERN = re.compile(r"\b([0-9a-fA-F]{32})\b")
+
+class StoredFile(NamedTuple):
+    path: Path
+    md5: str
+    size: int
+    format: str
+
+def detect_format(header: bytes) -> str:
+    """name a book format from the first HEADER_SIZE bytes of the file"""
+    if (header.startswith(b"PK\x03\x04")):
+        #An epub is a zip whose first entry is an uncompressed "mimetype" file
+        return "epub" if header[30:58] == b"mimetypeapplication/epub+zip" else "zip"
+    if (header.startswith(b"%PDF-")): return "pdf"
+    if (header[60:68] in (b"BOOKMOBI", b"TEXtREAd")): return "mobi"
+    if (header.startswith(b"AT&TFORM")): return "djvu"
+    if (b"<FictionBook" in header or header.lstrip().startswith(b"<?xml")): return "fb2"
+    return "unknown"
+
+def link_md5(url: str) -> Optional[str]:
+    """the md5 libgen puts in its mirror links, which is the md5 of the file they serve"""
+    match = MD5_PATTERN.search(url)
+    return match.group(1).lower() if match is not None else None
+
+def file_md5(path: Path) -> str:
+    md5 = hashlib.md5()
+    with path.open("rb") as file:
+        while (chunk := file.read(READ_SIZE)):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+def verify_file(path: Path, record: Dict[str, Any]) -> Optional[str]:
+    """return what is wrong with a downloaded book's file, None if it looks intact"""
+    try:
+        size = path.stat().st_size
+        with path.open("rb") as file:
+            header = file.read(HEADER_SIZE)
+            file.seek(max(size - 1024, 0))
+            tail = file.read()
+        if (record.get("size") is not None and size != record["size"]):
+            return "truncated" if size < record["size"] else f"size is {size} bytes, expected {record['size']}"
+        if (record.get("md5") is not None and file_md5(path) != record["md5"]):
+            return "checksum mismatch"
+    except FileNotFoundError:
+        return "missing"
+    except OSError as error:
+        return f"unreadable ({error.strerror})"
+
+    file_format = detect_format(header)
+    if (file_format == "unknown"):
+        return "not a recognised book format"
+    if (file_format in ("epub", "zip")):
+        try:
+            with zipfile.ZipFile(path) as archive:
+                if (archive.testzip() is not None): return "corrupt archive"
+        except (zipfile.BadZipFile, OSError):
+            return "corrupt archive"
+    if (file_format == "pdf" and b"%%EOF" not in tail):
+        return "truncated pdf"
+    return None
@@ -0,0 +1,36 @@
+# goldfinch/listing.py
+
+import csv
+import io
+import json
+from typing import Any, Dict, List
+
+import typer
+
+from database import BUCKETS
+
+OUTPUT_FORMATS = ("text", "json", "jsonl", "tsv")
+TSV_COLUMNS = ("status", "title", "author", "date_added", "date_downloaded", "link", "key", "attempts", "failure_reason")
+
+def format_books(books: List[Dict[str, Any]], output_format: str, headings: tuple = ()) -> str:
+    """render books in one string so they can be written in a single call, headings groups text output by bucket"""
+    if (output_format == "json"):
+        return json.dumps(books, indent=4) + "\n"
+    if (output_format == "jsonl"):
+        return "".join(json.dumps(book) + "\n" for book in books)
+    if (output_format == "tsv"):
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, delimiter="\t", lineterminator="\n")
+        writer.writerow(TSV_COLUMNS)
+        writer.writerows([book.get(column) or "" for column in TSV_COLUMNS] for book in books)
+        return buffer.getvalue()
+    if (not headings):
+        return "".join(typer.style(f"{book['title']} by {book['author']}\n", fg=typer.colors.WHITE) for book in books)
+    lines = []
+    for bucket in headings:
+        lines.append(typer.style(f"{bucket.replace("_", " ").title()}\n", fg=typer.colors.GREEN))
+        lines.extend(
+            typer.style(f"\t{book['title']} by {book['author']}\n", fg=typer.colors.WHITE)
+            for book in books if book["status"] == BUCKETS[bucket]
+        )
+    return "".join(lines)
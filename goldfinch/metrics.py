@@ -0,0 +1,130 @@
+# goldfinch/metrics.py
+
+import functools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Dict, List
+
+class Metrics:
+    """thread safe timers, counters and per-mirror statistics for a single run"""
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.started = time.time()
+        self.timers: Dict[str, Dict[str, float]] = {}
+        self.counters: Dict[str, int] = {}
+        self.mirrors: Dict[str, Dict[str, float]] = {}
+
+    @contextmanager
+    def timer(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def timed(self, name: str):
+        """decorator timing every call of a function under name"""
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.timer(name):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def observe(self, name: str, seconds: float) -> None:
+        with self._lock:
+            timer = self.timers.setdefault(name, {"calls": 0, "seconds": 0.0, "max_seconds": 0.0})
+            timer["calls"] += 1
+            timer["seconds"] += seconds
+            timer["max_seconds"] = max(timer["max_seconds"], seconds)
+
+    def count(self, name: str, value: int = 1) -> None:
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def record_mirror(self, host: str, latency: float, ok: bool, size: int = 0, transfer_seconds: float = 0.0) -> None:
+        """record one attempt at a mirror: page latency, bytes transferred and whether the file arrived"""
+        with self._lock:
+            mirror = self.mirrors.setdefault(host, {
+                "attempts": 0, "successes": 0, "latency_seconds": 0.0, "bytes": 0, "transfer_seconds": 0.0
+            })
+            mirror["attempts"] += 1
+            mirror["successes"] += 1 if ok else 0
+            mirror["latency_seconds"] += latency
+            mirror["bytes"] += size
+            mirror["transfer_seconds"] += transfer_seconds
+
+    def reset(self) -> None:
+        with self._lock:
+            self.started = time.time()
+            self.timers.clear()
+            self.counters.clear()
+            self.mirrors.clear()
+
+    def to_dict(self) -> Dict[str, Any]:
+        with self._lock:
+            mirrors = {}
+            for host, mirror in self.mirrors.items():
+                mirrors[host] = dict(mirror)
+                mirrors[host]["mean_latency_seconds"] = mirror["latency_seconds"] / mirror["attempts"]
+                mirrors[host]["success_rate"] = mirror["successes"] / mirror["attempts"]
+                mirrors[host]["bytes_per_second"] = mirror["bytes"] / mirror["transfer_seconds"] if mirror["transfer_seconds"] else 0.0
+            return {
+                "started": self.started,
+                "wall_seconds": time.time() - self.started,
+                "timers": {name: dict(timer) for name, timer in self.timers.items()},
+                "counters": dict(self.counters),
+                "mirrors": mirrors,
+            }
+
+    def summary(self) -> List[str]:
+        """human readable lines for the end of a run"""
+        report = self.to_dict()
+        lines = [f"Run took {report['wall_seconds']:.1f}s"]
+        for name, timer in sorted(report["timers"].items(), key=lambda item: item[1]["seconds"], reverse=True):
+            lines.append(f"\t{name}: {timer['calls']} calls, {timer['seconds']:.2f}s total, "
+                         f"{timer['seconds'] / timer['calls'] * 1000:.0f}ms mean, {timer['max_seconds'] * 1000:.0f}ms max")
+        for name, value in sorted(report["counters"].items()):
+            lines.append(f"\t{name}: {value}")
+        for host, mirror in sorted(report["mirrors"].items()):
+            lines.append(f"\tmirror {host}: {mirror['successes']}/{mirror['attempts']} ok, "
+                         f"{mirror['mean_latency_seconds'] * 1000:.0f}ms mean latency, "
+                         f"{mirror['bytes_per_second'] / 1024:.0f} KiB/s")
+        return lines
+
+    def write_json(self, path: Path) -> None:
+        _write_atomic(path, json.dumps(self.to_dict(), indent=4))
+
+    def write_prometheus(self, path: Path) -> None:
+        """write the last run in the node exporter textfile collector format, one gauge family per statistic"""
+        report = self.to_dict()
+        families = {
+            "goldfinch_run_seconds": {"": report["wall_seconds"]},
+            "goldfinch_last_run_timestamp_seconds": {"": report["started"]},
+            "goldfinch_phase_calls": {f'phase="{name}"': timer["calls"] for name, timer in report["timers"].items()},
+            "goldfinch_phase_seconds": {f'phase="{name}"': timer["seconds"] for name, timer in report["timers"].items()},
+            "goldfinch_events": {f'event="{name}"': value for name, value in report["counters"].items()},
+        }
+        for statistic in ("attempts", "successes", "latency_seconds", "bytes", "transfer_seconds"):
+            families[f"goldfinch_mirror_{statistic}"] = {
+                f'host="{host}"': mirror[statistic] for host, mirror in report["mirrors"].items()
+            }
+        lines = []
+        for family, samples in families.items():
+            lines.append(f"# TYPE {family} gauge")
+            for labels, value in samples.items():
+                lines.append(f"{family}{{{labels}}} {value}" if labels else f"{family} {value}")
+        _write_atomic(path, "\n".join(lines) + "\n")
+
+def _write_atomic(path: Path, content: str) -> None:
+    #The node exporter may read the file at any moment, never let it see a partial write
+    temp_path = path.with_name(path.name + ".tmp")
+    temp_path.write_text(content)
+    os.replace(temp_path, path)
+
+METRICS = Metrics()
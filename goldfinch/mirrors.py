@@ -0,0 +1,97 @@
+# goldfinch/mirrors.py
+
+import json
+import os
+import threading
+import time
+import urllib.parse
+from pathlib import Path
+from typing import Dict, List
+
+from config import DEFAULT_MIRROR_HEALTH_PATH, DEFAULT_MIRROR_FAILURE_THRESHOLD, DEFAULT_MIRROR_COOLDOWN_MINUTES
+
+#Weight of the newest observation in the moving averages
+SMOOTHING = 0.3
+#Assumed cost of a host with no history, between a fast mirror and a slow one
+UNKNOWN_COST = 5.0
+TYPICAL_BOOK_BYTES = 2 * 1024 * 1024
+
+class MirrorHealth:
+    """persistent per-host latency, throughput and failure history with a circuit breaker"""
+    def __init__(
+        self,
+        path: Path = DEFAULT_MIRROR_HEALTH_PATH,
+        failure_threshold: int = DEFAULT_MIRROR_FAILURE_THRESHOLD,
+        cooldown_minutes: float = DEFAULT_MIRROR_COOLDOWN_MINUTES,
+    ) -> None:
+        self.path = path
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown_minutes * 60
+        self._lock = threading.Lock()
+        self.hosts: Dict[str, Dict[str, float]] = self._load()
+
+    def _load(self) -> Dict[str, Dict[str, float]]:
+        try:
+            with self.path.open("r") as file:
+                return json.load(file)
+        except (OSError, json.JSONDecodeError):
+            #Losing the history only costs a few slow attempts
+            return {}
+
+    def save(self) -> None:
+        with self._lock:
+            content = json.dumps(self.hosts, indent=4)
+        temp_path = self.path.with_name(self.path.name + ".tmp")
+        try:
+            temp_path.write_text(content)
+            os.replace(temp_path, self.path)
+        except OSError:
+            pass
+
+    def record(self, host: str, latency: float, ok: bool, size: int = 0, transfer_seconds: float = 0.0) -> None:
+        with self._lock:
+            stats = self.hosts.setdefault(host, {
+                "attempts": 0,
+                "failures": 0,
+                "consecutive_failures": 0,
+                "latency": latency,
+                "throughput": None,
+                "opened_at": None,
+            })
+            stats["attempts"] += 1
+            stats["latency"] = (1 - SMOOTHING) * stats["latency"] + SMOOTHING * latency
+            if (ok):
+                stats["consecutive_failures"] = 0
+                stats["opened_at"] = None
+                if (size and transfer_seconds):
+                    throughput = size / transfer_seconds
+                    previous = stats["throughput"] or throughput
+                    stats["throughput"] = (1 - SMOOTHING) * previous + SMOOTHING * throughput
+                return
+            stats["failures"] += 1
+            stats["consecutive_failures"] += 1
+            if (stats["consecutive_failures"] >= self.failure_threshold):
+                #Open the circuit, or re-open it after a failed trial once the cooldown ended
+                stats["opened_at"] = time.time()
+
+    def is_available(self, host: str) -> bool:
+        """false while a host's circuit is open, true again once its cooldown has passed"""
+        with self._lock:
+            stats = self.hosts.get(host)
+            if (stats is None or stats["opened_at"] is None): return True
+            return time.time() - stats["opened_at"] >= self.cooldown
+
+    def expected_cost(self, host: str) -> float:
+        """rough seconds to fetch a book from host, inflated by its failure rate"""
+        with self._lock:
+            stats = self.hosts.get(host)
+            if (stats is None): return UNKNOWN_COST
+            transfer = TYPICAL_BOOK_BYTES / stats["throughput"] if stats["throughput"] else UNKNOWN_COST
+            success_rate = (stats["attempts"] - stats["failures"] + 1) / (stats["attempts"] + 2)
+            return (stats["latency"] + transfer) / success_rate
+
+    def order(self, urls: List[str]) -> List[str]:
+        """drop urls on hosts with an open circuit and sort the rest cheapest first, keeping ties in order"""
+        hosts = {url: urllib.parse.urlparse(url).netloc for url in urls}
+        available = [url for url in urls if self.is_available(hosts[url])]
+        return sorted(available, key=lambda url: self.expected_cost(hosts[url]))
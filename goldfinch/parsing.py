@@ -0,0 +1,18 @@
+# goldfinch/parsing.py
+
+from bs4 import BeautifulSoup, SoupStrainer
+
+try:
+    import lxml  # noqa: F401
+    PARSER = "lxml"
+except ImportError:
+    PARSER = "html.parser"
+
+#Only the parts of each page goldfinch reads are turned into a tree
+FICTION_RESULTS = SoupStrainer("table", class_ = "catalog")
+NONFICTION_RESULTS = SoupStrainer("table", class_ = "c")
+MIRROR_DOWNLOAD = SoupStrainer("div", id = "download")
+
+def make_soup(content: bytes, parse_only: SoupStrainer = None) -> BeautifulSoup:
+    """parse content with lxml when it is installed, keeping only the elements parse_only matches"""
+    return BeautifulSoup(content, PARSER, parse_only=parse_only)
@@ -0,0 +1,79 @@
+# goldfinch/ranking.py
+
+import re
+import unicodedata
+from difflib import SequenceMatcher
+from typing import Any, Dict, List
+
+MIN_TITLE_SCORE = 0.6
+TITLE_WEIGHT = 0.6
+AUTHOR_WEIGHT = 0.25
+FORMAT_WEIGHT = 0.1
+SIZE_WEIGHT = 0.05
+FORMAT_SCORES = {
+    "epub": 1.0,
+    "azw3": 0.6,
+    "mobi": 0.6,
+    "fb2": 0.4,
+    "pdf": 0.3,
+}
+BRACKETS_PATTERN = re.compile(r"[\[({].*?[\])}]")
+PUNCTUATION_PATTERN = re.compile(r"[^\w\s]")
+SIZE_PATTERN = re.compile(r"([\d.]+)\s*([kmg]?)b", re.IGNORECASE)
+SIZE_UNITS = {"": 1 / (1024 * 1024), "k": 1 / 1024, "m": 1, "g": 1024}
+
+def normalize(text: str) -> str:
+    """lowercase, drop accents, bracketed notes like (Series #1) and punctuation"""
+    text = unicodedata.normalize("NFKD", text)
+    text = "".join(char for char in text if not unicodedata.combining(char))
+    text = BRACKETS_PATTERN.sub(" ", text.lower())
+    text = PUNCTUATION_PATTERN.sub(" ", text)
+    return " ".join(text.split())
+
+def title_score(wanted: str, found: str) -> float:
+    wanted, found = normalize(wanted), normalize(found)
+    if (not wanted or not found): return 0.0
+    if (wanted == found): return 1.0
+    ratio = SequenceMatcher(None, wanted, found).ratio()
+    #"Dune" vs "Dune: Deluxe Edition", a subtitle shouldn't sink a match
+    if (found.startswith(wanted) or wanted.startswith(found)):
+        ratio = max(ratio, 0.85)
+    return ratio
+
+def author_score(wanted: str, found: str) -> float:
+    """compare names as sets of words so "Herbert, Frank" matches "Frank Herbert" """
+    wanted_words, found_words = set(normalize(wanted).split()), set(normalize(found).split())
+    if (not wanted_words or not found_words): return 0.0
+    return len(wanted_words & found_words) / len(wanted_words)
+
+def size_score(size: str) -> float:
+    """prefer ordinary book sizes over suspiciously tiny or huge files"""
+    match = SIZE_PATTERN.search(size or "")
+    if (match is None): return 0.5
+    megabytes = float(match.group(1)) * SIZE_UNITS[match.group(2).lower()]
+    if (megabytes < 0.05): return 0.0
+    if (megabytes > 100): return 0.3
+    return 1.0
+
+def score(result: Dict[str, Any], title: str, author: str) -> float:
+    return (
+        TITLE_WEIGHT * title_score(title, result["title"])
+        + AUTHOR_WEIGHT * author_score(author, result["author"])
+        + FORMAT_WEIGHT * FORMAT_SCORES.get(result["extension"].lower(), 0.0)
+        + SIZE_WEIGHT * size_score(result["size"])
+    )
+
+def rank(results: List[Dict[str, Any]], title: str, author: str) -> List[Dict[str, Any]]:
+    """return the results that look like the wanted book, best match first and without the same file twice"""
+    scored = [
+        (score(result, title, author), result) for result in results
+        if title_score(title, result["title"]) >= MIN_TITLE_SCORE and result["mirrors"]
+    ]
+    scored.sort(key=lambda scored_result: scored_result[0], reverse=True)
+    ranked = []
+    seen = set()
+    for _, result in scored:
+        if (result["mirrors"][0] in seen): continue
+        seen.add(result["mirrors"][0])
+        ranked.append(result)
+    return ranked
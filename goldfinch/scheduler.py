@@ -0,0 +1,89 @@
+# goldfinch/scheduler.py
+
+import os
+import socket
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, NamedTuple, Optional
+
+from config import DEFAULT_RETRY_BACKOFF_HOURS, DEFAULT_MAX_RETRY_BACKOFF_HOURS
+
+#A claim from another machine can't be checked, it's given up on once it is this old
+CLAIM_TIMEOUT = timedelta(hours=12)
+
+class Plan(NamedTuple):
+    keys: List[str]
+    backing_off: int
+    next_due: Optional[datetime]
+
+def record_failure(book: Dict[str, Any], reason: str, now: datetime = None) -> Dict[str, Any]:
+    """the failed_books record of a book whose download just failed"""
+    now = now or datetime.now()
+    return dict(book, attempts=book.get("attempts", 0) + 1,
+                last_attempt=now.isoformat(timespec="seconds"), failure_reason=reason)
+
+def next_attempt(book: Dict[str, Any], backoff_hours: float = DEFAULT_RETRY_BACKOFF_HOURS,
+                 max_backoff_hours: float = DEFAULT_MAX_RETRY_BACKOFF_HOURS) -> Optional[datetime]:
+    """when a failed book may be tried again, doubling the wait after every failure; None if it can be now"""
+    if (not book.get("last_attempt") or not book.get("attempts")): return None
+    try:
+        last_attempt = datetime.fromisoformat(book["last_attempt"])
+    except ValueError:
+        return None
+    hours = min(backoff_hours * 2 ** (book["attempts"] - 1), max_backoff_hours)
+    return last_attempt + timedelta(hours=hours)
+
+def priority_key(book: Dict[str, Any]) -> tuple:
+    """sort key putting the books most worth a run's time first"""
+    try:
+        added = datetime.strptime(book["date_added"], "%m-%d-%Y").toordinal() if book.get("date_added") else 0
+    except ValueError:
+        added = 0
+    #Higher user priority, then books that have failed less, then the newest on the shelf
+    return (-book.get("priority", 0), book.get("attempts", 0), -added)
+
+def plan(books: Dict[str, Dict[str, Any]], max_books: int = None, now: datetime = None,
+         backoff_hours: float = DEFAULT_RETRY_BACKOFF_HOURS,
+         max_backoff_hours: float = DEFAULT_MAX_RETRY_BACKOFF_HOURS) -> Plan:
+    """the keys of the books to try, in the order to try them, leaving out those still backing off"""
+    now = now or datetime.now()
+    due = []
+    waiting = []
+    for key, book in books.items():
+        retry_at = next_attempt(book, backoff_hours, max_backoff_hours)
+        if (retry_at is not None and retry_at > now):
+            waiting.append(retry_at)
+            continue
+        due.append(key)
+    #sorted is stable, so books that tie keep the database's order
+    due = sorted(due, key=lambda key: priority_key(books[key]))
+    if (max_books is not None):
+        due = due[:max_books]
+    return Plan(due, len(waiting), min(waiting, default=None))
+
+def new_claim(now: datetime = None) -> Dict[str, Any]:
+    """the mark a process puts on the books it is about to download"""
+    now = now or datetime.now()
+    return {"pid": os.getpid(), "host": socket.gethostname(), "at": now.isoformat(timespec="seconds")}
+
+def is_claimed(book: Dict[str, Any], now: datetime = None) -> bool:
+    """whether another process that is still running is downloading a book"""
+    claim = book.get("claim")
+    if (not claim): return False
+    now = now or datetime.now()
+    try:
+        if (now - datetime.fromisoformat(claim["at"]) > CLAIM_TIMEOUT): return False
+    except (KeyError, TypeError, ValueError):
+        return False
+    if (claim.get("host") != socket.gethostname()): return True
+    #On this machine the claim lasts as long as the process that made it.
+    #A process downloads one batch at a time, so its own claims are left over from a batch that didn't finish
+    if (claim.get("pid") == os.getpid()): return False
+    try:
+        os.kill(claim["pid"], 0)
+    except ProcessLookupError:
+        return False
+    except (PermissionError, KeyError, TypeError):
+        return True
+    except OSError:
+        return False
+    return True
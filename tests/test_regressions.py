@@ -0,0 +1,193 @@
+# tests/test_regressions.py
+
+"""Regression checks for bugs found in review, runnable on their own against the local fake server.
+
+    python -m unittest discover tests
+"""
+
+import contextlib
+import io
+import json
+import sys
+import tempfile
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+sys.path[:0] = [str(Path(__file__).resolve().parent.parent / "goldfinch"), str(Path(__file__).resolve().parent.parent / "benchmarks")]
+
+import fixtures
+from fake_server import FakeServer
+from __init__ import SUCCESS, CANT_REACH_LIBGEN, NO_SHELF
+import database
+import goldfinch
+import identity
+from cache import SearchCache
+from downloader import Downloader
+from http_client import HTTPClient, RateLimiter
+from library import StoredFile
+from mirrors import MirrorHealth
+from ranking import rank
+
+class KnownFileTest(unittest.TestCase):
+    def test_sequel_in_library_does_not_stand_in_for_book(self) -> None:
+        """a sequel already in the library ranks as a candidate, but mustn't stand in for the book itself"""
+        book_md5, sequel_md5 = fixtures.md5("dune"), fixtures.md5("dune-messiah")
+        with FakeServer() as server, tempfile.TemporaryDirectory() as workdir:
+            results = [
+                {"title": "Dune Messiah", "author": "Frank Herbert", "extension": "epub", "size": "1 Mb",
+                 "mirrors": [f"{server.base_url}/fiction/{sequel_md5}"]},
+                {"title": "Dune", "author": "Frank Herbert", "extension": "epub", "size": "1 Mb",
+                 "mirrors": [f"{server.base_url}/fiction/{book_md5}"]},
+            ]
+            downloader = Downloader(Path(workdir), http_client=HTTPClient(backoff_factor=0), libgen_url=server.base_url)
+            sequel_path = Path(workdir) / "Dune_Messiah.epub"
+            sequel_path.write_bytes(b"")
+            downloader.known_files[sequel_md5.lower()] = StoredFile(sequel_path, sequel_md5.lower(), 0, "epub")
+            with contextlib.redirect_stdout(io.StringIO()):
+                url, _, known = downloader.try_url_download(downloader.order_mirrors(rank(results, "Dune", "Frank Herbert")),
+                                                             Path(workdir) / "dune.download")
+        self.assertTrue(url.endswith(book_md5))
+        self.assertIsNone(known)
+
+class KeyUpgradeTest(unittest.TestCase):
+    def test_legacy_database_is_rekeyed_without_losing_books(self) -> None:
+        """a database from before canonical ids, keyed by title + author as typed, is re-keyed without losing books"""
+        legacy = {
+            "undownloaded_books": {
+                "DuneHerbert, Frank": {"title": "Dune", "author": "Herbert, Frank", "date_added": "01-02-2023"},
+                "EmmaJane Austen": {"title": "Emma", "author": "Jane Austen", "date_added": "01-03-2023"},
+                "Middlemarch George Eliot": {"title": "Middlemarch ", "author": "George Eliot", "date_added": "01-04-2023"},
+            },
+            "downloaded_books": {
+                "DuneFrank Herbert": {"title": "Dune", "author": "Frank Herbert", "date_added": "01-02-2023",
+                                      "date_downloaded": "01-05-2023 10:00:00", "link": "http://library.lol/main/ABC"},
+            },
+            "failed_books": {
+                "EmmaAusten, Jane": {"title": "Emma", "author": "Austen, Jane", "date_added": "01-03-2023"},
+            },
+            "date_since_download": "01-01-2023",
+            "sync_watermark": {"date_added": "01-04-2023", "keys": ["Middlemarch George Eliot", "DuneHerbert, Frank"]},
+        }
+        with tempfile.TemporaryDirectory() as workdir:
+            db_path = Path(workdir) / "database.json"
+            db_path.write_text(json.dumps(legacy, indent=4))
+            db_handler = database.get_db_handler(db_path)
+            read = db_handler.read_db()
+            self.assertEqual(read.error, SUCCESS)
+            self.assertEqual(read.db["key_version"], identity.KEY_VERSION)
+            #Downloaded wins over failed, which wins over undownloaded
+            self.assertEqual(list(read.db["downloaded_books"]), ["dune|frank herbert"])
+            self.assertEqual(read.db["downloaded_books"]["dune|frank herbert"]["link"], "http://library.lol/main/ABC")
+            self.assertEqual(list(read.db["failed_books"]), ["emma|austen jane"])
+            self.assertEqual(list(read.db["undownloaded_books"]), ["middlemarch|eliot george"])
+            self.assertEqual(read.db["sync_watermark"]["keys"], ["middlemarch|eliot george", "dune|frank herbert"])
+            self.assertEqual(db_handler.write_db(read.db).error, SUCCESS)
+            self.assertEqual(db_handler.read_db().db, read.db)
+
+class BookIdsTest(unittest.TestCase):
+    def test_downloaded_and_requeued_books_keep_their_ids(self) -> None:
+        """a shelf row whose title changed is still found by its Goodreads id once the book was downloaded or requeued"""
+        with FakeServer(3) as server, tempfile.TemporaryDirectory() as workdir:
+            db_path = Path(workdir) / "database.json"
+            database.init_database(db_path, "01-01-2000")
+            gf = goldfinch.Goldfinch(db_path, server.shelf_url, Path(workdir), libgen_url=server.base_url,
+                                     http_client=HTTPClient(backoff_factor=0, retries=0))
+            with contextlib.redirect_stdout(io.StringIO()):
+                self.assertEqual(gf.sync_shelf().error, SUCCESS)
+                self.assertEqual(gf.download_all(False), SUCCESS)
+            db = gf.db_handler.read_db().db
+            key, record = next(iter(db["downloaded_books"].items()))
+            renamed = {"title": "A New Edition", "author": record["author"], "goodreads_id": record["goodreads_id"]}
+            self.assertEqual(identity.BookIndex(db).find(renamed), key)
+
+            Path(record["path"]).unlink()
+            with contextlib.redirect_stdout(io.StringIO()):
+                self.assertEqual(gf.verify(requeue=True).error, SUCCESS)
+            db = gf.db_handler.read_db().db
+            self.assertIn(key, db["undownloaded_books"])
+            self.assertEqual(identity.BookIndex(db).find(renamed), key)
+
+class SearchErrorTest(unittest.TestCase):
+    def test_error_page_is_not_cached(self) -> None:
+        """a libgen error page is a failed search, not one that found nothing, and is tried again next time"""
+        with FakeServer(failure_rate=1.0) as server, tempfile.TemporaryDirectory() as workdir:
+            search_cache = SearchCache(cache_path=Path(workdir) / "cache.sqlite")
+            downloader = Downloader(Path(workdir), http_client=HTTPClient(backoff_factor=0, retries=0),
+                                    search_cache=search_cache, libgen_url=server.base_url)
+            search_response = downloader.search_libgen("Dune", "Frank Herbert", Downloader.TITLE, Downloader.FICTION)
+            self.assertEqual(search_response.error, CANT_REACH_LIBGEN)
+            self.assertIsNone(search_cache.get(SearchCache.make_key("Dune", "Frank Herbert", Downloader.TITLE, Downloader.FICTION)))
+
+class OpenCircuitsTest(unittest.TestCase):
+    def test_open_mirrors_are_tried_when_nothing_else_is_left(self) -> None:
+        """a book whose every mirror has an open circuit is still tried rather than failed without a request"""
+        with tempfile.TemporaryDirectory() as workdir:
+            mirror_health = MirrorHealth(Path(workdir) / "mirrors.json", failure_threshold=1)
+            mirror_health.record("library.lol", 1.0, False)
+            downloader = Downloader(Path(workdir), mirror_health=mirror_health)
+            ranked = [{"title": "Dune", "author": "Frank Herbert", "mirrors": ["http://library.lol/main/ABC"]}]
+            self.assertFalse(mirror_health.is_available("library.lol"))
+            self.assertEqual(downloader.order_mirrors(ranked), ["http://library.lol/main/ABC"])
+
+class NoShelfTest(unittest.TestCase):
+    def test_config_without_shelves_reports_no_shelf(self) -> None:
+        with tempfile.TemporaryDirectory() as workdir:
+            db_path = Path(workdir) / "database.json"
+            database.init_database(db_path, "01-01-2000")
+            gf = goldfinch.Goldfinch(db_path, "", Path(workdir), shelves={})
+            self.assertEqual(gf.sync_shelf().error, NO_SHELF)
+
+class CountingLimiter(RateLimiter):
+    def __init__(self) -> None:
+        super().__init__(requests_per_second=0)
+        self.acquired = 0
+
+    def acquire(self, host: str) -> None:
+        self.acquired += 1
+        super().acquire(host)
+
+class BadGatewayHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    requests = 0
+
+    def log_message(self, *args) -> None:
+        pass
+
+    def do_GET(self) -> None:
+        BadGatewayHandler.requests += 1
+        self.send_response(502)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+class RetryRateLimitTest(unittest.TestCase):
+    def test_server_error_retries_take_a_token_each(self) -> None:
+        server = ThreadingHTTPServer(("127.0.0.1", 0), BadGatewayHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            limiter = CountingLimiter()
+            client = HTTPClient(retries=2, backoff_factor=0, rate_limiter=limiter)
+            response = client.get(f"http://127.0.0.1:{server.server_address[1]}/")
+            self.assertEqual(response.status_code, 502)
+            self.assertEqual(BadGatewayHandler.requests, 3)
+            self.assertEqual(limiter.acquired, 3)
+            client.close()
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_connection_error_retries_take_a_token_each(self) -> None:
+        import requests
+
+        server = ThreadingHTTPServer(("127.0.0.1", 0), BadGatewayHandler)
+        port = server.server_address[1]
+        server.server_close()
+        limiter = CountingLimiter()
+        client = HTTPClient(retries=2, backoff_factor=0, rate_limiter=limiter)
+        with self.assertRaises(requests.ConnectionError):
+            client.get(f"http://127.0.0.1:{port}/")
+        self.assertEqual(limiter.acquired, 3)
+
+if __name__ == "__main__":
+    unittest.main()